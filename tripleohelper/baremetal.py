@@ -16,6 +16,7 @@
 # under the License.
 
 import tripleohelper.server as server
+from tripleohelper import trace
 
 import json
 
@@ -28,6 +29,7 @@ class Baremetal(server.Server):
         self.name = None
 
 
+@trace.traced_methods
 class BaremetalFactory(object):
     def __init__(self, instackenv_file=None, instackenv_content=None):
         if instackenv_file:
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""The facts of a remote host.
+
+The facts are collected by the static/gather_facts script, in a single
+round trip, and returned as JSON. They are grouped:
+
+- hostname: the name, the short name and the content of /etc/hostname
+- kernel: the running release and the default kernel of grubby
+- memory: the total of memory and of swap, in bytes
+- nics: the MAC address, the MTU and the state of each interface
+- os_release: the content of /etc/os-release
+- packages: the epoch:version-release.arch of each installed RPM, a
+  package installed by Server.yum_install() since the gathering has
+  the version None
+"""
+
+import json
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from tripleohelper.utils import pkg_data_filename
+
+GROUPS = ('hostname', 'kernel', 'memory', 'nics', 'os_release', 'packages')
+
+_SCRIPT = None
+
+
+def command(groups):
+    """Return the command that prints the given groups of facts."""
+    global _SCRIPT
+    if _SCRIPT is None:
+        with open(pkg_data_filename('static', 'gather_facts')) as fd:
+            _SCRIPT = fd.read()
+    return '$(command -v python3 || command -v python) -c %s %s' % (
+        quote(_SCRIPT), ' '.join(groups))
+
+
+def parse(output):
+    """Load the output of the command."""
+    return json.loads(output.decode('UTF-8'))
@@ -15,6 +15,7 @@
 # under the License.
 
 from tripleohelper.server import Server
+from tripleohelper import trace
 from tripleohelper.undercloud import Undercloud
 
 from jinja2 import Environment
@@ -24,6 +25,7 @@ from tripleohelper.utils import pkg_data_filename
 import os
 
 
+@trace.traced_methods
 class Host0(Server):
     """An host0 is an libvirt hypervisor that can be used to spawn VMs.
 
@@ -49,16 +51,18 @@ class Host0(Server):
         self.run('systemctl start libvirtd')
         self.run('systemctl status libvirtd')
 
-        self.install_base_packages()
-        self.clean_system()
-        self.yum_update()
+        with self.yum_transaction():
+            self.install_base_packages()
+            self.clean_system()
+            self.yum_update()
 
     def build_undercloud_on_libvirt(self, image_path,
                                     rhsm=None, repositories=[]):
         """Build the Undercloud by using instack-virt-setup script."""
         self.run('sysctl net.ipv4.ip_forward=1')
+        # virt-customize modifies the image
         self.fetch_image(path=image_path, dest='/home/stack/guest_image.qcow2',
-                         user='stack')
+                         user='stack', writable=True)
         # NOTE(Gonéri): this is a hack for our OpenStack, the MTU of its outgoing route
         # is 1400 and libvirt do not provide a mechanism to adjust the guests MTU.
         self.run("LIBGUESTFS_BACKEND=direct virt-customize -a /home/stack/guest_image.qcow2 --run-command 'echo MTU=\"1400\" >> /etc/sysconfig/network-scripts/ifcfg-eth0'")
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A content-addressed cache of the images downloaded on a remote host.
+
+The static/fetch_image script downloads each image once in the cache
+directory of the remote user, then links it to its destinations. See the
+script for the details. The tarballs that are not worth keeping are
+extracted on the fly by the static/extract_image script instead.
+"""
+
+import hashlib
+import re
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from tripleohelper.utils import pkg_data_filename
+
+# relative to the home directory of the remote user
+DEFAULT_CACHE_DIR = '.cache/tripleohelper/images'
+DEFAULT_CACHE_SIZE = 20 * 1024 ** 3
+DEFAULT_SEGMENTS = 4
+DEFAULT_SEGMENT_SIZE = 16 * 1024 ** 2
+
+_SCRIPTS = {}
+
+
+def key(url, digest=None):
+    """Return the name of the cache entry of an URL."""
+    return hashlib.sha256(
+        ('%s %s' % (url, digest or '')).encode('UTF-8')).hexdigest()
+
+
+def command(url, dest, digest=None, writable=False,
+            segments=DEFAULT_SEGMENTS, segment_size=DEFAULT_SEGMENT_SIZE,
+            cache_dir=DEFAULT_CACHE_DIR, cache_size=DEFAULT_CACHE_SIZE):
+    """Return the command that fetches an URL through the cache.
+
+    :param url: the URL to download
+    :param dest: the remote path of the file
+    :param digest: the expected digest, like 'sha256:0123...'
+    :param writable: if True, dest is a copy that the caller may modify,
+    it is not replaced if it exists. Otherwise, dest is a hardlink to the
+    cache entry.
+    :param segments: the number of parallel range downloads
+    :param segment_size: the minimal size of a range
+    :param cache_dir: the remote cache directory
+    :param cache_size: the size over which the least recently used entries
+    are evicted, in bytes
+    """
+    args = [url, dest, key(url, digest), digest or '', int(writable),
+            segments, segment_size, cache_dir, cache_size]
+    return _script_command('fetch_image', args)
+
+
+def extract_command(url, digest=None):
+    """Return the command that extracts a tarball while it is downloaded.
+
+    The tarball is not stored, nor cached. The last line of the output is
+    "extracted <digest> <bytes> <milliseconds>", see parse_extraction().
+
+    :param url: the URL of the tarball
+    :param digest: the expected digest, like 'sha256:0123...'
+    """
+    return _script_command('extract_image', [url, digest or ''])
+
+
+def parse_extraction(output):
+    """Return the (digest, bytes, seconds) tuple of an extraction."""
+    match = re.search(r'^extracted (\S+) (\d+) (\d+)', output, re.M)
+    return match.group(1), int(match.group(2)), int(match.group(3)) / 1000.0
+
+
+def _script_command(name, args):
+    if name not in _SCRIPTS:
+        with open(pkg_data_filename('static', name)) as fd:
+            _SCRIPTS[name] = fd.read()
+    return 'bash -c %s %s %s' % (
+        quote(_SCRIPTS[name]), name, ' '.join(quote(str(a)) for a in args))
@@ -16,6 +16,7 @@
 # under the License.
 
 import tripleohelper.baremetal
+from tripleohelper import trace
 
 
 class Baremetal(tripleohelper.baremetal.Baremetal):
@@ -23,6 +24,7 @@ class Baremetal(tripleohelper.baremetal.Baremetal):
         pass
 
 
+@trace.traced_methods
 class BaremetalFactory(tripleohelper.baremetal.BaremetalFactory):
     def __init__(self, hypervisor=None, **kargs):
         super(BaremetalFactory, self).__init__(**kargs)
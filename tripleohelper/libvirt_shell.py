@@ -15,6 +15,7 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import atexit
 import click
 import yaml
 
@@ -24,6 +25,8 @@ import traceback
 import tripleohelper.host0
 import tripleohelper.libvirt_baremetal
 from tripleohelper import logger
+from tripleohelper import stats
+from tripleohelper import trace
 from tripleohelper import undercloud
 
 
@@ -37,16 +40,29 @@ LOG = logging.getLogger('tripleohelper')
               help="IP address of the hypervisor to reuse.")
 @click.option('--config-file', required=True, type=click.File('rb'),
               help="Chainsaw path configuration file.")
+@click.option('--stats-file', type=click.Path(),
+              help="Write the timing of the remote operations in this JSON file.")
+@click.option('--trace-file', type=click.Path(),
+              help="Write a Chrome trace of the run in this JSON file.")
 @click.argument('step', nargs=1, required=True,
                 type=click.Choice(['provisioning', 'undercloud', 'overcloud', 'cleanup']))
-def cli(host0_ip, undercloud_ip, config_file, step):
+def cli(host0_ip, undercloud_ip, config_file, stats_file, trace_file,
+        step):
     config = yaml.load(config_file)
     ssh = config['ssh']
     host0 = None
     vm_undercloud = None
 
     print('step: %s' % step)
-    logger.setup_logging(config_file=config.get('config_file'))
+    logger.setup_logging(config_file=config.get('config_file'),
+                         host_log_dir=config.get('host_log_dir'))
+    if stats_file:
+        # the steps end with exit()
+        atexit.register(stats.STATS.dump, stats_file)
+    if trace_file:
+        trace.TRACER.enable()
+        trace.TRACER.begin('step %s' % step, 'cli')
+        atexit.register(trace.TRACER.dump, trace_file)
     try:
         rhsm = config.get('rhsm')
         host0 = tripleohelper.host0.Host0(
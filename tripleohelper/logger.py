@@ -14,11 +14,252 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import atexit
+import gzip
 import logging
+import logging.handlers
+import os
 import sys
+import threading
+import time
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-def setup_logging(extra_handlers=(), config_file='chainsaw.log'):
+try:
+    from logging.handlers import QueueHandler
+    from logging.handlers import QueueListener
+except ImportError:
+    # Python 2.7
+    class QueueHandler(logging.Handler):
+        """Put the records in a queue, the formatting is done by a listener."""
+        def __init__(self, queue):
+            logging.Handler.__init__(self)
+            self.queue = queue
+
+        def enqueue(self, record):
+            self.queue.put_nowait(record)
+
+        def prepare(self, record):
+            # the arguments and the traceback may not survive the thread
+            # change, merge them in the message
+            record.msg = self.format(record)
+            record.args = None
+            record.exc_info = None
+            return record
+
+        def emit(self, record):
+            try:
+                self.enqueue(self.prepare(record))
+            except Exception:
+                self.handleError(record)
+
+    class QueueListener(object):
+        """Pass the records of a queue to some handlers, in a thread."""
+        _sentinel = None
+
+        def __init__(self, queue, *handlers, **kwargs):
+            self.queue = queue
+            self.handlers = handlers
+            self.respect_handler_level = kwargs.get(
+                'respect_handler_level', False)
+            self._thread = None
+
+        def dequeue(self, block):
+            return self.queue.get(block)
+
+        def start(self):
+            self._thread = threading.Thread(target=self._monitor)
+            self._thread.daemon = True
+            self._thread.start()
+
+        def handle(self, record):
+            for handler in self.handlers:
+                if self.respect_handler_level:
+                    if record.levelno < handler.level:
+                        continue
+                handler.handle(record)
+
+        def _monitor(self):
+            while True:
+                record = self.dequeue(True)
+                if record is self._sentinel:
+                    break
+                self.handle(record)
+
+        def enqueue_sentinel(self):
+            self.queue.put_nowait(self._sentinel)
+
+        def stop(self):
+            self.enqueue_sentinel()
+            self._thread.join()
+            self._thread = None
+
+
+# the maximum number of records waiting for the listener
+QUEUE_SIZE = 4096
+
+
+class BlockingQueueHandler(QueueHandler):
+    """Wait for room in a bounded queue instead of dropping the record.
+
+    A listener that falls behind slows down the loggers, the memory used
+    by the pending records stays bounded.
+    """
+    def enqueue(self, record):
+        self.queue.put(record)
+
+
+class FlushingQueueListener(QueueListener):
+    """Flush the handlers once the queue has been idle for a while.
+
+    The records buffered by a BatchingHandler are written even if no
+    record follows them, like the last lines before a long silent command.
+    """
+    def __init__(self, queue, *handlers, **kwargs):
+        self.idle_interval = kwargs.pop('idle_interval', 1)
+        QueueListener.__init__(self, queue, *handlers, **kwargs)
+
+    def dequeue(self, block):
+        try:
+            return self.queue.get(block, self.idle_interval)
+        except queue.Empty:
+            for handler in self.handlers:
+                handler.flush()
+            return self.queue.get(block)
+
+    def enqueue_sentinel(self):
+        # the queue may be full
+        self.queue.put(self._sentinel)
+
+
+# the listener of the handlers set up by setup_logging()
+_LISTENER = None
+
+
+class BatchingHandler(logging.handlers.MemoryHandler):
+    """Write the records of a StreamHandler in batches.
+
+    The buffered records are written with a single write() and a single
+    flush(), when the buffer is full, after an error or once the interval
+    has elapsed since the last write.
+    """
+    def __init__(self, target, capacity=512, interval=1,
+                 flushLevel=logging.ERROR):
+        logging.handlers.MemoryHandler.__init__(
+            self, capacity, flushLevel=flushLevel, target=target)
+        self.interval = interval
+        self._last_flush = time.time()
+
+    def shouldFlush(self, record):
+        if logging.handlers.MemoryHandler.shouldFlush(self, record):
+            return True
+        return time.time() - self._last_flush >= self.interval
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.target and self.buffer:
+                terminator = getattr(self.target, 'terminator', '\n')
+                content = ''.join(
+                    self.target.format(record) + terminator
+                    for record in self.buffer)
+                self.target.acquire()
+                try:
+                    self.target.stream.write(content)
+                    self.target.flush()
+                finally:
+                    self.target.release()
+                self.buffer = []
+            self._last_flush = time.time()
+        finally:
+            self.release()
+
+    def close(self):
+        target = self.target
+        logging.handlers.MemoryHandler.close(self)
+        if target:
+            target.close()
+
+
+class PerHostHandler(logging.Handler):
+    """Write the records of each remote host in a compressed file.
+
+    The records of the SSH clients carry the name of their host, they
+    are written in <directory>/<host>.log.gz. The other records are
+    ignored.
+    """
+    def __init__(self, directory):
+        logging.Handler.__init__(self)
+        self.directory = directory
+        self._files = {}
+
+    def emit(self, record):
+        host = getattr(record, 'host', None)
+        if host is None:
+            return
+        try:
+            if host not in self._files:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                self._files[host] = gzip.open(
+                    os.path.join(self.directory, '%s.log.gz' % host), 'wb')
+            self._files[host].write(
+                (self.format(record) + '\n').encode('UTF-8'))
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self.acquire()
+        try:
+            for fd in self._files.values():
+                fd.close()
+            self._files = {}
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+    def flush(self):
+        self.acquire()
+        try:
+            for fd in self._files.values():
+                fd.flush()
+        finally:
+            self.release()
+
+
+def stop_logging():
+    """Write the records still in the queue and stop the listener."""
+    global _LISTENER
+    if _LISTENER is None:
+        return
+    # the queue would block the loggers once full
+    logger = logging.getLogger('tripleohelper')
+    for handler in logger.handlers[:]:
+        if isinstance(handler, QueueHandler):
+            logger.removeHandler(handler)
+    _LISTENER.stop()
+    for handler in _LISTENER.handlers:
+        handler.close()
+    _LISTENER = None
+
+
+def setup_logging(extra_handlers=(), config_file='chainsaw.log',
+                  host_log_dir=None):
+    """Log in the terminal and in a file, from a listener thread.
+
+    The loggers only put the records in a queue, a slow terminal or a slow
+    file system does not slow down the SSH clients, until QUEUE_SIZE
+    records are pending: the loggers then wait for the listener.
+
+    :param extra_handlers: some handlers to call from the listener as well
+    :param config_file: the path of the log file
+    :param host_log_dir: if set, the directory of the per-host log files
+    """
+    global _LISTENER
+    stop_logging()
     logger = logging.getLogger('tripleohelper')
     logger.setLevel(logging.DEBUG)
     formatter = logging.Formatter(
@@ -47,7 +288,16 @@ def setup_logging(extra_handlers=(), config_file='chainsaw.log'):
         stream_handler.setFormatter(colored_formatter)
     except ImportError:
         pass
-    logger.addHandler(stream_handler)
-    logger.addHandler(file_handler)
-    for handler in extra_handlers:
-        logger.addHandler(handler)
+    handlers = [stream_handler, BatchingHandler(file_handler)]
+    if host_log_dir:
+        host_handler = PerHostHandler(host_log_dir)
+        host_handler.setFormatter(formatter)
+        handlers.append(host_handler)
+    handlers.extend(extra_handlers)
+
+    records = queue.Queue(QUEUE_SIZE)
+    logger.addHandler(BlockingQueueHandler(records))
+    _LISTENER = FlushingQueueListener(records, *handlers)
+    _LISTENER.start()
+    # before logging.shutdown(), which closes the handlers
+    atexit.register(stop_logging)
@@ -23,10 +23,12 @@ from tripleohelper import ovb_bmc
 import tripleohelper.provisioners.openstack.provisioner as os_provisioner
 from tripleohelper.provisioners.openstack import utils as os_utils
 import tripleohelper.server as server
+from tripleohelper import trace
 
 LOG = logging.getLogger('tripleohelper')
 
 
+@trace.traced_methods
 class Baremetal(server.Server):
     """A baremetal node."""
     def __init__(self, nova_api, neutron, keypair, key_filename, security_groups, name):
@@ -123,6 +125,7 @@ class Baremetal(server.Server):
         undercloud.run(command.format(node_ip=self.hostname), user='stack', success_status=(0, 255,))
 
 
+@trace.traced_methods
 class BaremetalFactory(tripleohelper.baremetal.BaremetalFactory):
     def __init__(self, nova_api, neutron, keypair, key_filename, security_groups,
                  os_params={}):
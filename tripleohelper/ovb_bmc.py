@@ -20,12 +20,14 @@ import sys
 import tripleohelper.provisioners.openstack.provisioner as os_provisioner
 from tripleohelper.provisioners.openstack import utils as os_utils
 from tripleohelper.server import Server
+from tripleohelper import trace
 from tripleohelper.utils import pkg_data_filename
 from tripleohelper.utils import protect_password
 
 LOG = logging.getLogger('tripleohelper')
 
 
+@trace.traced_methods
 class OvbBmc(Server):
     """A virtual BMC for OVB.
 
@@ -152,13 +154,14 @@ ONBOOT=yes
         self.create_file(
             '/etc/sysconfig/network-scripts/route-%s' % device,
             content=content.format(bmc_gw=bmc_gw))
-        self.run('ifup %s' % device)
+        with self.batch() as batch:
+            batch.run('ifup %s' % device)
 
-        # Ensure the outgoing traffic go through the correct NIC to avoid spoofing
-        # protection
-        # TODO(Gonéri): This should be persistant.
-        self.run('ip rule add from %s table %d' % (bmc_ip, self._nic_cpt + 2))
-        self.run('ip route add default via %s dev %s table %d' % (bmc_gw, device, self._nic_cpt + 2))
+            # Ensure the outgoing traffic go through the correct NIC to avoid spoofing
+            # protection
+            # TODO(Gonéri): This should be persistant.
+            batch.run('ip rule add from %s table %d' % (bmc_ip, self._nic_cpt + 2))
+            batch.run('ip route add default via %s dev %s table %d' % (bmc_gw, device, self._nic_cpt + 2))
 
         content = """
 [Unit]
@@ -182,8 +185,9 @@ WantedBy=multi-user.target
                 os_auth_url=self.os_auth_url,
                 bm_instance=bm_instance,
                 bmc_ip=bmc_ip))
-        self.run('systemctl enable %s' % unit)
-        self.run('systemctl start %s' % unit)
+        with self.batch() as batch:
+            batch.run('systemctl enable %s' % unit)
+            batch.run('systemctl start %s' % unit)
         self._nic_cpt += 1
 
         return bmc_ip
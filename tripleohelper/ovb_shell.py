@@ -15,6 +15,7 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import atexit
 import click
 import os
 import time
@@ -26,6 +27,8 @@ import tripleohelper.chaos_monkey
 from tripleohelper import logger
 from tripleohelper import ovb_baremetal
 from tripleohelper import ovb_undercloud
+from tripleohelper import stats
+from tripleohelper import trace
 from tripleohelper.provisioners.openstack import utils as os_utils
 import tripleohelper.undercloud
 import tripleohelper.watcher
@@ -142,17 +145,33 @@ def initialize_network(neutron):
               help="Openstack project ID.")
 @click.option('--config-file', required=True, type=click.File('rb'),
               help="Chainsaw path configuration file.")
+@click.option('--stats-file', type=click.Path(),
+              help="Write the timing of the remote operations in this JSON file.")
+@click.option('--trace-file', type=click.Path(),
+              help="Write a Chrome trace of the run in this JSON file.")
 @click.argument('step', nargs=1, required=True,
                 type=click.Choice(['provisioning', 'undercloud', 'overcloud', 'cleanup']))
-def cli(os_auth_url, os_username, os_password, os_project_id, config_file, step):
+def cli(os_auth_url, os_username, os_password, os_project_id, config_file,
+        stats_file, trace_file, step):
     config = yaml.load(config_file)
-    logger.setup_logging(config_file=config.get('config_file'))
+    logger.setup_logging(config_file=config.get('config_file'),
+                         host_log_dir=config.get('host_log_dir'))
+    if stats_file:
+        # the steps end with exit()
+        atexit.register(stats.STATS.dump, stats_file)
+    if trace_file:
+        trace.TRACER.enable()
+        trace.TRACER.begin('step %s' % step, 'cli')
+        atexit.register(trace.TRACER.dump, trace_file)
     undercloud = None
     baremetal_factory = None
 
     sess = os_utils.ks_session(os_auth_url, os_username, os_password, os_project_id)
     neutron = os_utils.build_neutron_client(sess)
     nova_api = os_utils.build_nova_api(sess)
+    if trace_file:
+        neutron = trace.TracedProxy(neutron, 'neutron')
+        nova_api = trace.TracedProxy(nova_api, 'nova')
     provisioner = config['provisioner']
 
     print('step: %s' % step)
@@ -269,7 +288,7 @@ undercloud_admin_vip = 192.0.2.201
         if deployment_file:
             remote_path = "/home/stack/%s" % os.path.basename(deployment_file)
             undercloud.send_file(deployment_file, remote_path, user='stack',
-                                 unix_mode=0o755)
+                                 unix_mode=0o755, delta=True)
             undercloud.start_overcloud_deploy(deploy_command=remote_path)
         else:
             undercloud.start_overcloud_deploy(
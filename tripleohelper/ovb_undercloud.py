@@ -19,6 +19,7 @@ import sys
 
 import tripleohelper.provisioners.openstack.provisioner as os_provisioner
 from tripleohelper.provisioners.openstack import utils as os_utils
+from tripleohelper import trace
 from tripleohelper.undercloud import Undercloud
 from tripleohelper.utils import pkg_data_filename
 from tripleohelper.utils import protect_password
@@ -26,6 +27,7 @@ from tripleohelper.utils import protect_password
 LOG = logging.getLogger('tripleohelper')
 
 
+@trace.traced_methods
 class OVBUndercloud(Undercloud):
     """An undercloud for OVB.
 
@@ -15,13 +15,88 @@
 # under the License.
 
 
+import collections
+import concurrent.futures
+import contextlib
 import logging
 import os
 
+from paramiko import ssh_exception
+
+from tripleohelper import facts
+from tripleohelper import image_cache
 from tripleohelper import ssh
 
 LOG = logging.getLogger('tripleohelper')
 
+DEFAULT_MAX_WORKERS = 10
+
+
+class CommandBatch(object):
+    """Gather commands to run them later in a single round trip.
+
+    See Server.batch().
+    """
+    def __init__(self):
+        self.commands = []
+        self.results = None
+
+    def run(self, cmd, sudo=False, ignore_error=False, success_status=(0,),
+            error_callback=None, custom_log=None):
+        """Queue a command, the parameters are the ones of Server.run()."""
+        self.commands.append({
+            'cmd': cmd,
+            'sudo': sudo,
+            'ignore_error': ignore_error,
+            'success_status': success_status,
+            'error_callback': error_callback,
+            'custom_log': custom_log})
+
+
+class YumTransaction(object):
+    """Gather package installs and removes to run them in a single command.
+
+    See Server.yum_transaction().
+
+    :param ignore_error: True if a failure of the yum run is not an error
+    """
+    def __init__(self, ignore_error=False):
+        self.install = []
+        self.remove = []
+        self.ignore_error = ignore_error
+
+    def add(self, install=(), remove=()):
+        """Queue some packages, the last operation on a package wins."""
+        for package in install:
+            if package in self.remove:
+                self.remove.remove(package)
+            if package not in self.install:
+                self.install.append(package)
+        for package in remove:
+            if package in self.install:
+                self.install.remove(package)
+            if package not in self.remove:
+                self.remove.append(package)
+
+    def command(self, installed):
+        """Return the yum command of the transaction.
+
+        :param installed: the package index, a dict indexed by package
+        name. The installed packages are not installed again, the missing
+        ones are not removed.
+        :return: the command, None if there is nothing to do
+        """
+        install = [p for p in self.install if p not in installed]
+        remove = [p for p in self.remove if p in installed]
+        # one yum run per kind of operation, their exit status tells
+        # the same as the separate yum_install() and yum_remove() calls
+        commands = []
+        if install:
+            commands.append('yum install -y --quiet ' + ' '.join(install))
+        if remove:
+            commands.append('yum remove -y --quiet ' + ' '.join(remove))
+        return ' && '.join(commands) or None
+
 
 class Server(object):
     """The base class for all the server objects.
@@ -50,6 +125,8 @@ class Server(object):
             'rhel-7-server-rpms',
             'rhel-7-server-optional-rpms',
             'rhel-7-server-extras-rpms']
+        self._facts = {}
+        self._yum_transaction = None
 
     def enable_user(self, user):
         """Enable the root account on the remote host.
@@ -102,17 +179,23 @@ class Server(object):
             key_filename=self._key_filename,
             via_ip=self.via_ip)
 
-    def send_file(self, local_path, remote_path, user='root', unix_mode=None):
+    def send_file(self, local_path, remote_path, user='root', unix_mode=None,
+                  delta=False, parallel=1):
         """Upload a local file on the remote host.
         """
         self.enable_user(user)
-        return self.ssh_pool.send_file(user, local_path, remote_path, unix_mode=unix_mode)
+        return self.ssh_pool.send_file(user, local_path, remote_path,
+                                       unix_mode=unix_mode, delta=delta,
+                                       parallel=parallel)
 
-    def send_dir(self, local_path, remote_path, user='root'):
+    def send_dir(self, local_path, remote_path, user='root', use_tar=False,
+                 compression=None, delta=False, delete=False):
         """Upload a directory on the remote host.
         """
         self.enable_user(user)
-        return self.ssh_pool.send_dir(user, local_path, remote_path)
+        return self.ssh_pool.send_dir(
+            user, local_path, remote_path, use_tar=use_tar,
+            compression=compression, delta=delta, delete=delete)
 
     def open(self, filename, mode='r', user='root'):
         self.enable_user(user)
@@ -125,32 +208,209 @@ class Server(object):
         return self.ssh_pool.create_file(user, path, content, mode)
 
     def run(self, cmd, user='root', sudo=False, ignore_error=False,
-            success_status=(0,), error_callback=None, custom_log=None, retry=0):
+            success_status=(0,), error_callback=None, custom_log=None, retry=0,
+            capture=None):
         """Run a command on the remote host.
         """
         self.enable_user(user)
         return self.ssh_pool.run(
             user, cmd, sudo=sudo, ignore_error=ignore_error,
             success_status=success_status, error_callback=error_callback,
-            custom_log=custom_log, retry=retry)
+            custom_log=custom_log, retry=retry, capture=capture)
+
+    def run_async(self, cmd, user='root', sudo=False, ignore_error=False,
+                  success_status=(0,), error_callback=None, custom_log=None,
+                  retry=0, capture=None):
+        """Run a command on the remote host in the background.
+
+        :return: the future of the (output, exit status) tuple, see
+        ssh.gather() to wait for several of them.
+        """
+        self.enable_user(user)
+        return self.ssh_pool.run_async(
+            user, cmd, sudo=sudo, ignore_error=ignore_error,
+            success_status=success_status, error_callback=error_callback,
+            custom_log=custom_log, retry=retry, capture=capture)
+
+    def query(self, cmd, user='root', sudo=False, ignore_error=False,
+              success_status=(0,), custom_log=None):
+        """Run a command whose output is meant to be parsed.
+
+        See ssh.SshClient.query(), the outputs are returned as bytes.
+        """
+        self.enable_user(user)
+        return self.ssh_pool.query(
+            user, cmd, sudo=sudo, ignore_error=ignore_error,
+            success_status=success_status, custom_log=custom_log)
+
+    def run_many(self, commands, user='root'):
+        """Run a list of commands on the remote host in a single round trip.
+
+        See ssh.SshClient.run_many().
+        """
+        self.enable_user(user)
+        return self.ssh_pool.run_many(user, commands)
+
+    @contextlib.contextmanager
+    def batch(self, user='root'):
+        """Gather the commands and run them in a single round trip.
+
+        The commands are run when the block is left, their results are
+        stored in the results attribute of the batch.
+
+            with server.batch() as batch:
+                batch.run('systemctl enable network')
+                batch.run('systemctl restart network')
+        """
+        commands = CommandBatch()
+        yield commands
+        if commands.commands:
+            commands.results = self.run_many(commands.commands, user=user)
+
+    def stream(self, cmd, user='root', sudo=False, ignore_error=False,
+               success_status=(0,), custom_log=None):
+        """Run a command on the remote host and iterate over its output lines.
+        """
+        self.enable_user(user)
+        return self.ssh_pool.stream(
+            user, cmd, sudo=sudo, ignore_error=ignore_error,
+            success_status=success_status, custom_log=custom_log)
 
     def get_file_content(self, filename, user='root'):
-        with self.open(filename, user=user) as f:
-            return f.read().decode()
+        return b''.join(self.iter_file(filename, user=user)).decode()
+
+    def iter_file(self, remote_path, user='root', chunk_size=1048576):
+        """Iterate over the content of a remote file, chunk by chunk.
+        """
+        self.enable_user(user)
+        return self.ssh_pool.iter_file(user, remote_path, chunk_size)
+
+    def get_file(self, remote_path, local_path, user='root'):
+        """Download a file from the remote host.
+        """
+        self.enable_user(user)
+        return self.ssh_pool.get_file(user, remote_path, local_path)
+
+    def get_files(self, files, user='root', max_workers=4):
+        """Download several files from the remote host in parallel.
+
+        :param files: a list of (remote path, local path) tuples
+        """
+        self.enable_user(user)
+        return self.ssh_pool.get_files(user, files, max_workers=max_workers)
+
+    def facts(self, *groups):
+        """Return the facts of the host, see tripleohelper.facts.
+
+        The missing groups are gathered in a single round trip, then cached
+        until invalidate_facts() is called.
+
+        :param groups: the groups of facts to return, all by default
+        :return: a dict of facts, indexed by group
+        """
+        groups = groups or facts.GROUPS
+        missing = [g for g in groups if g not in self._facts]
+        if missing:
+            stdout, _, _ = self.query(
+                facts.command(missing),
+                custom_log='gather the facts: %s' % ', '.join(missing))
+            self._facts.update(facts.parse(stdout))
+        return dict((g, self._facts[g]) for g in groups)
+
+    def invalidate_facts(self, *groups):
+        """Drop some groups of facts from the cache, all by default.
+
+        The methods that change the host call it, the next facts() call
+        gathers the groups again.
+        """
+        for group in groups or facts.GROUPS:
+            self._facts.pop(group, None)
 
     def yum_install(self, packages, ignore_error=False):
         """Install some packages on the remote host.
 
+        The packages already installed are skipped. In a yum_transaction()
+        block, the installation is queued.
+
         :param packages: ist of packages to install.
         """
-        return self.run('yum install -y --quiet ' + ' '.join(packages), ignore_error=ignore_error, retry=5)
+        return self._yum(install=packages, ignore_error=ignore_error)
 
     def yum_remove(self, packages):
         """Remove some packages from a remote host.
 
+        The packages that are not installed are skipped. In a
+        yum_transaction() block, the removal is queued.
+
         :param packages: ist of packages to remove.
         """
-        return self.run('yum remove -y --quiet ' + ' '.join(packages))
+        return self._yum(remove=packages)
+
+    @contextlib.contextmanager
+    def yum_transaction(self):
+        """Merge the package installs and removes in a single command.
+
+        The yum_install() and yum_remove() calls of the block are queued,
+        the installs are merged in a single yum run, then the removes. They
+        are run when the block is left or when flush_yum_transaction() is
+        called. A call with ignore_error is not merged, to not hide the
+        failures of the other calls: the queued calls are run first, then
+        this one on its own.
+
+            with server.yum_transaction():
+                server.install_base_packages()
+                server.clean_system()
+        """
+        if self._yum_transaction is not None:
+            # the outer block runs the transaction
+            yield self._yum_transaction
+            return
+        self._yum_transaction = YumTransaction()
+        try:
+            yield self._yum_transaction
+            transaction = self._yum_transaction
+        finally:
+            self._yum_transaction = None
+        self._run_yum_transaction(transaction)
+
+    def flush_yum_transaction(self):
+        """Run the queued package installs and removes now."""
+        if self._yum_transaction is not None:
+            transaction = self._yum_transaction
+            self._yum_transaction = YumTransaction()
+            self._run_yum_transaction(transaction)
+
+    def _yum(self, install=(), remove=(), ignore_error=False):
+        if self._yum_transaction is not None and not ignore_error:
+            self._yum_transaction.add(install, remove)
+            return
+        self.flush_yum_transaction()
+        transaction = YumTransaction(ignore_error=ignore_error)
+        transaction.add(install, remove)
+        return self._run_yum_transaction(transaction)
+
+    def _run_yum_transaction(self, transaction):
+        if not transaction.install and not transaction.remove:
+            return
+        installed = self.facts('packages')['packages']
+        cmd = transaction.command(installed)
+        if cmd is None:
+            LOG.debug('%s: the packages are up to date' % self.hostname)
+            return
+        # the index is unknown if the run fails
+        self.invalidate_facts('packages')
+        result = self.run(cmd, ignore_error=transaction.ignore_error, retry=5)
+        if result[1] == 0:
+            # the versions of the new packages are unknown until the index
+            # is gathered again, like the dependencies yum has installed or
+            # removed along
+            installed = dict(installed)
+            for package in transaction.remove:
+                installed.pop(package, None)
+            for package in transaction.install:
+                installed.setdefault(package, None)
+            self._facts['packages'] = installed
+        return result
 
     def rhsm_register(self, rhsm):
         """Register the host on the RHSM.
@@ -200,26 +460,40 @@ class Server(object):
         packages = [r['name'] for r in repositories if r['type'] == 'package']
         if packages:
             self.yum_install(packages)
+            # the next packages may come from these repositories
+            self.flush_yum_transaction()
 
     def create_stack_user(self):
         """Create the stack user on the machine.
         """
         self.run('adduser -m stack', success_status=(0, 9))
         self.create_file('/etc/sudoers.d/stack', 'stack ALL=(root) NOPASSWD:ALL\n')
-        self.run('mkdir -p /home/stack/.ssh')
-        self.run('cp /root/.ssh/authorized_keys /home/stack/.ssh/authorized_keys')
-        self.run('chown -R stack:stack /home/stack/.ssh')
-        self.run('chmod 700 /home/stack/.ssh')
-        self.run('chmod 600 /home/stack/.ssh/authorized_keys')
+        with self.batch() as batch:
+            batch.run('mkdir -p /home/stack/.ssh')
+            batch.run('cp /root/.ssh/authorized_keys /home/stack/.ssh/authorized_keys')
+            batch.run('chown -R stack:stack /home/stack/.ssh')
+            batch.run('chmod 700 /home/stack/.ssh')
+            batch.run('chmod 600 /home/stack/.ssh/authorized_keys')
         self.ssh_pool.build_ssh_client(self.hostname, 'stack',
                                        self._key_filename,
                                        self.via_ip)
 
-    def fetch_image(self, path, dest, user='root'):
+    def fetch_image(self, path, dest, user='root', digest=None,
+                    writable=False):
         """Store in the user home directory an image from a remote location.
+
+        The image goes through the cache of the remote user, it is
+        downloaded once and verified, see tripleohelper.image_cache.
+
+        :param path: the URL of the image
+        :param dest: the remote path of the image
+        :param digest: the expected digest, like 'sha256:0123...'
+        :param writable: True if the caller modifies the image in place
         """
-        self.run('test -f %s || curl -L -s -o %s %s' % (dest, dest, path),
-                 user=user, ignore_error=True)
+        self.run(image_cache.command(path, dest, digest=digest,
+                                     writable=writable),
+                 user=user, retry=3,
+                 custom_log='fetch %s to %s' % (path, dest))
 
     def install_base_packages(self):
         """Install some extra packages.
@@ -232,12 +506,17 @@ class Server(object):
     def clean_system(self):
         """Clean up unnecessary packages from the system.
         """
-        self.run('systemctl disable NetworkManager', success_status=(0, 1))
-        self.run('systemctl stop NetworkManager', success_status=(0, 5))
-        self.run('pkill -9 dhclient', success_status=(0, 1))
+        with self.batch() as batch:
+            batch.run('systemctl disable NetworkManager', success_status=(0, 1))
+            batch.run('systemctl stop NetworkManager', success_status=(0, 5))
+            batch.run('pkill -9 dhclient', success_status=(0, 1))
         self.yum_remove(['cloud-init', 'NetworkManager'])
-        self.run('systemctl enable network')
-        self.run('systemctl restart network')
+        # the network is restarted once NetworkManager is removed
+        self.flush_yum_transaction()
+        with self.batch() as batch:
+            batch.run('systemctl enable network')
+            batch.run('systemctl restart network')
+        self.invalidate_facts('nics')
 
     def yum_update(self, allow_reboot=False):
         """Do a yum update on the system.
@@ -245,19 +524,42 @@ class Server(object):
         :param allow_reboot: If True and if a new kernel has been installed,
         the system will be rebooted
         """
+        self.flush_yum_transaction()
         self.run('yum clean all')
-        self.run('test -f /usr/bin/subscription-manager && subscription-manager repos --list-enabled',
-                 ignore_error=True)
-        self.run('yum repolist')
-        self.run('yum update -y --quiet', retry=3)
+        ssh.gather([
+            self.run_async('test -f /usr/bin/subscription-manager && subscription-manager repos --list-enabled',
+                           ignore_error=True),
+            self.run_async('yum repolist')])
+        self.invalidate_facts('packages', 'kernel')
+        self.run('yum update -y --quiet', retry=3,
+                 capture=ssh.CapturePolicy())
         # reboot if a new initrd has been generated since the boot
         if allow_reboot:
             self.run('grubby --set-default $(ls /boot/vmlinuz-*.x86_64|tail -1)')
-            default_kernel = self.run('grubby --default-kernel')[0].rstrip()
-            cur_kernel = self.run('uname -r')[0].rstrip()
-            if cur_kernel not in default_kernel:
-                self.run('reboot', ignore_error=True)
-            self.ssh_pool.stop_all()
+            kernel = self.facts('kernel')['kernel']
+            if kernel['release'] not in (kernel['default'] or ''):
+                self.reboot()
+
+    def reboot(self, timeout=None):
+        """Reboot the host and wait until it is back.
+
+        The connections are reopened as soon as the ssh service of the new
+        boot answers.
+
+        :param timeout: the number of seconds to wait, see
+        ssh.SshClient.wait_for_reboot()
+        """
+        self.enable_user('root')
+        boot_id = self.ssh_pool.read_boot_id('root')
+        # only the installed packages survive a reboot for sure
+        self.invalidate_facts(
+            *[g for g in facts.GROUPS if g != 'packages'])
+        try:
+            self.run('reboot', ignore_error=True)
+        except (ssh_exception.SSHException, EOFError, IOError) as e:
+            # the connection may be closed before the end of the command
+            LOG.debug('%s: %s' % (self.hostname, e))
+        self.ssh_pool.wait_for_reboot(boot_id, timeout=timeout)
 
     def install_osp(self):
         """Install the OSP distribution.
@@ -280,3 +582,158 @@ class Server(object):
         The file will be re-sourced before any new command invocation.
         """
         return self.ssh_pool.add_environment_file(user, filename)
+
+    def enable_shell_session(self, user='root', enabled=True):
+        """Run the commands of a user in a persistent remote shell.
+
+        The environment files are sourced once for all and each command
+        only costs a write and a read on an existing channel.
+        """
+        self.enable_user(user)
+        return self.ssh_pool.enable_shell_session(user, enabled)
+
+    def enable_environment_snapshot(self, user='root', enabled=True):
+        """Source the environment files of a user only once.
+
+        See ssh.SshClient.enable_environment_snapshot().
+        """
+        self.enable_user(user)
+        return self.ssh_pool.enable_environment_snapshot(user, enabled)
+
+
+class GroupResult(object):
+    """The per-host outcome of a ServerGroup operation.
+
+    results and errors are ordered dicts indexed by hostname, in the order
+    of the servers of the group. The hostnames of the servers are distinct,
+    see ServerGroup.map().
+    """
+    def __init__(self, name):
+        self.name = name
+        self.results = collections.OrderedDict()
+        self.errors = collections.OrderedDict()
+
+    def __bool__(self):
+        return not self.errors
+    __nonzero__ = __bool__
+
+    def raise_on_error(self):
+        """Raise an SSHException that lists the hosts in failure, if any."""
+        if self.errors:
+            msg = '%s failed on %d host(s): %s' % (
+                self.name, len(self.errors),
+                ', '.join('%s (%s)' % (h, e) for h, e in self.errors.items()))
+            raise ssh_exception.SSHException(msg)
+        return self
+
+
+class ServerGroup(object):
+    """Run the same operation on several servers in parallel.
+
+    The operations are spread over a bounded thread pool, they return a
+    GroupResult and do not raise if some hosts fail, see
+    GroupResult.raise_on_error().
+
+        group = ServerGroup(undercloud.baremetal_factory.nodes)
+        group.yum_install(['tmux']).raise_on_error()
+    """
+    def __init__(self, servers, max_workers=DEFAULT_MAX_WORKERS):
+        """:param servers: a list of Server objects
+        :param max_workers: the number of servers to drive at the same time.
+        """
+        self.servers = list(servers)
+        self._max_workers = max_workers
+
+    def __len__(self):
+        return len(self.servers)
+
+    def __iter__(self):
+        return iter(self.servers)
+
+    def map(self, func, *args, **kwargs):
+        """Call func(server, *args, **kwargs) for each server of the group.
+
+        A progress line is logged each time a host completes. The outcomes
+        are indexed by hostname: a ValueError is raised before anything is
+        run if a hostname is unset or shared by several servers.
+        """
+        name = getattr(func, '__name__', 'operation')
+        group_result = GroupResult(name)
+        hostnames = [server.hostname for server in self.servers]
+        if None in hostnames or len(set(hostnames)) != len(hostnames):
+            raise ValueError(
+                '%s: the servers of a group need distinct hostnames, got %s' % (
+                    name, ', '.join(str(h) for h in hostnames)))
+        if not self.servers:
+            return group_result
+        outcomes = [None] * len(self.servers)
+        workers = min(self._max_workers, len(self.servers))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict(
+                (executor.submit(func, server, *args, **kwargs), index)
+                for index, server in enumerate(self.servers))
+            for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                index = futures[future]
+                try:
+                    outcomes[index] = (True, future.result())
+                    status = 'ok'
+                except Exception as e:
+                    outcomes[index] = (False, e)
+                    status = 'failed: %s' % e
+                LOG.info('%s [%d/%d] %s: %s' % (
+                    name, done, len(self.servers), hostnames[index], status))
+        for hostname, (success, value) in zip(hostnames, outcomes):
+            if success:
+                group_result.results[hostname] = value
+            else:
+                group_result.errors[hostname] = value
+        return group_result
+
+    def _call(self, method_name, *args, **kwargs):
+        def call(server):
+            return getattr(server, method_name)(*args, **kwargs)
+        call.__name__ = method_name
+        return self.map(call)
+
+    def warm_up(self, user='root'):
+        """Open the SSH connections of all the servers in parallel.
+
+        The hosts that are still booting are waited for concurrently,
+        instead of one after the other by the first operation.
+        """
+        return self._call('enable_user', user)
+
+    def run(self, cmd, user='root', sudo=False, ignore_error=False,
+            success_status=(0,), error_callback=None, custom_log=None, retry=0,
+            capture=None):
+        """Run a command on all the servers, see Server.run()."""
+        return self._call(
+            'run', cmd, user=user, sudo=sudo, ignore_error=ignore_error,
+            success_status=success_status, error_callback=error_callback,
+            custom_log=custom_log, retry=retry, capture=capture)
+
+    def send_file(self, local_path, remote_path, user='root', unix_mode=None,
+                  delta=False, parallel=1):
+        """Upload a local file on all the servers, see Server.send_file()."""
+        return self._call('send_file', local_path, remote_path, user=user,
+                          unix_mode=unix_mode, delta=delta, parallel=parallel)
+
+    def create_file(self, path, content, mode='w', user='root'):
+        """Create a file on all the servers, see Server.create_file()."""
+        return self._call('create_file', path, content, mode=mode, user=user)
+
+    def yum_install(self, packages, ignore_error=False):
+        """Install some packages on all the servers."""
+        return self._call('yum_install', packages, ignore_error=ignore_error)
+
+    def enable_repositories(self, repositories):
+        """Enable a list of repositories on all the servers."""
+        return self._call('enable_repositories', repositories)
+
+
+def warm_up(servers, user='root', max_workers=DEFAULT_MAX_WORKERS):
+    """Open the SSH connections of a list of servers in parallel.
+
+    See ServerGroup.warm_up().
+    """
+    return ServerGroup(servers, max_workers=max_workers).warm_up(user)
@@ -17,15 +17,488 @@
 import paramiko
 from paramiko import ssh_exception
 
+from tripleohelper import stats
+from tripleohelper import trace
+
+import codecs
+import concurrent.futures
+import collections
+import contextlib
+import gzip
+import hashlib
 import io
 import logging
+import mmap
 import os
-import select
+import random
+import re
 import socket
+import tarfile
+import tempfile
+import threading
 import time
+import uuid
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
 
 LOG = logging.getLogger('tripleohelper')
 
+# The default number of commands a PoolSshClient runs concurrently, this
+# should stay below the MaxSessions of sshd (10 by default).
+DEFAULT_MAX_SESSIONS = 10
+
+# the number of seconds SshClient.start() waits for the ssh service
+DEFAULT_CONNECT_TIMEOUT = 90
+
+# the number of seconds SshClient.wait_for_reboot() waits for the host
+DEFAULT_REBOOT_TIMEOUT = 600
+
+# the number of seconds SshClient.probe() waits for the peer to answer
+DEFAULT_PROBE_TIMEOUT = 10
+
+# an operation probes the peer first if the last probe is older than this
+# number of seconds
+PROBE_INTERVAL = 10
+
+# the names of the variables an environment snapshot can export
+ENVIRONMENT_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# The result of a command run by SshClient.run_many(), duration is in seconds.
+CommandResult = collections.namedtuple(
+    'CommandResult', ['cmd', 'output', 'exit_status', 'duration'])
+
+
+class CapturedOutput(text_type):
+    """The output of a command run with a CapturePolicy.
+
+    It is the head and the tail of the output. If the middle has been
+    dropped, truncated is True and the full output is in the gzip file
+    spill_path.
+    """
+    spill_path = None
+    truncated = False
+    size = 0
+
+
+class CapturePolicy(object):
+    """Bound the memory used to capture the output of a command.
+
+    The first head_size and the last tail_size characters are kept in
+    memory. The full output is also written in a gzip file in spill_dir,
+    the file is removed if the output fits in memory.
+
+        server.run('openstack overcloud deploy ...',
+                   capture=ssh.CapturePolicy())
+    """
+    def __init__(self, head_size=65536, tail_size=262144, spill_dir=None):
+        """:param head_size: the number of characters kept from the start
+        :param tail_size: the number of characters kept from the end
+        :param spill_dir: where to write the full outputs, the temporary
+        directory by default
+        """
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.spill_dir = spill_dir
+
+    def open(self):
+        return _OutputCapture(self)
+
+
+class _OutputCapture(object):
+    def __init__(self, policy):
+        self._policy = policy
+        self._head = io.StringIO()
+        self._head_size = 0
+        self._tail = collections.deque()
+        self._tail_size = 0
+        self._size = 0
+        fd, self._spill_path = tempfile.mkstemp(
+            prefix='tripleohelper-', suffix='.log.gz', dir=policy.spill_dir)
+        self._spill = gzip.GzipFile(fileobj=os.fdopen(fd, 'wb'), mode='wb')
+
+    def write(self, text):
+        self._size += len(text)
+        self._spill.write(text.encode('UTF-8'))
+        if self._head_size < self._policy.head_size:
+            head = text[:self._policy.head_size - self._head_size]
+            self._head.write(head)
+            self._head_size += len(head)
+            text = text[len(head):]
+        if text:
+            self._tail.append(text)
+            self._tail_size += len(text)
+            while self._tail_size - len(self._tail[0]) >= self._policy.tail_size:
+                self._tail_size -= len(self._tail.popleft())
+
+    def getvalue(self):
+        """Close the spill file and return the stripped CapturedOutput."""
+        fileobj = self._spill.fileobj
+        self._spill.close()
+        fileobj.close()
+        tail = u''.join(self._tail)
+        truncated = self._head_size + len(tail) < self._size
+        if truncated:
+            tail = tail[-self._policy.tail_size:]
+            output = CapturedOutput(u'%s\n[... %d characters, see %s ...]\n%s' % (
+                self._head.getvalue().lstrip(),
+                self._size - self._head_size - len(tail),
+                self._spill_path, tail.rstrip()))
+            output.spill_path = self._spill_path
+        else:
+            os.remove(self._spill_path)
+            output = CapturedOutput((self._head.getvalue() + tail).strip())
+        output.truncated = truncated
+        output.size = self._size
+        return output
+
+
+def _file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for block in iter(lambda: fd.read(1048576), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def local_manifest(path):
+    """Describe the files of a local directory.
+
+    :param path: the path of the directory
+    :return: a dict with the file paths relative to the directory as keys
+    and the (size, sha256) tuples as values, like SshClient.remote_manifest().
+    """
+    manifest = {}
+    for walker in os.walk(path):
+        for file in walker[2]:
+            file_path = os.path.join(walker[0], file)
+            manifest[os.path.relpath(file_path, path)] = (
+                os.path.getsize(file_path), _file_sha256(file_path))
+    return manifest
+
+
+class ChannelReader(object):
+    """Read the output of a channel as soon as it is available.
+
+    Paramiko sets an event when some data or the EOF reach the channel, the
+    reader sleeps on this event instead of polling the channel. Each read
+    takes everything that is buffered (up to max_size), so the read size
+    follows the rate of the command output.
+    """
+    max_size = 1048576
+    # if the command has exited but a child process still holds its output
+    # open, the EOF never comes. We stop reading once the output has been
+    # quiet for exit_grace seconds.
+    exit_grace = 1
+
+    def __init__(self, channel, stderr=None):
+        """:param channel: the channel of the command
+        :param stderr: an optional list, if the standard error is not
+        combined, its chunks are appended to it while the output is read
+        """
+        self._channel = channel
+        self._stderr = stderr
+        self._event = threading.Event()
+        channel.in_buffer.set_event(self._event)
+        if stderr is not None:
+            channel.in_stderr_buffer.set_event(self._event)
+
+    def __iter__(self):
+        channel = self._channel
+        while True:
+            if channel.recv_ready():
+                yield channel.recv(self.max_size)
+            elif self._stderr is not None and channel.recv_stderr_ready():
+                self._stderr.append(channel.recv_stderr(self.max_size))
+            elif channel.eof_received or channel.closed:
+                return
+            elif not self._event.wait(self.exit_grace):
+                if channel.exit_status_ready():
+                    return
+
+
+class CommandStream(object):
+    """Iterate over the output of a remote command, line by line.
+
+    The lines are yielded as soon as they are received, without their line
+    terminator. Once the iteration is over, the exit status of the command
+    is available in the `exit_status` attribute.
+    """
+    def __init__(self, ssh_client, channel, custom_log, ignore_error=False,
+                 success_status=(0,), max_line_length=65536):
+        """:param ssh_client: the SshClient that started the command
+        :param channel: the channel of the running command
+        :param custom_log: the command label used in the logs
+        :param max_line_length: longer lines are yielded in several pieces,
+        this bounds the memory used by the stream.
+        :type max_line_length: int
+        """
+        self._ssh_client = ssh_client
+        self._channel = channel
+        self._custom_log = custom_log
+        self._ignore_error = ignore_error
+        self._success_status = success_status
+        self._max_line_length = max_line_length
+        self.exit_status = None
+
+    def _split(self, line):
+        pieces = [line[i:i + self._max_line_length]
+                  for i in range(0, len(line), self._max_line_length)] or ['']
+        for piece in pieces:
+            LOG.debug(piece, extra={'host': self._ssh_client._hostname})
+        return pieces
+
+    def __iter__(self):
+        decoder = codecs.getincrementaldecoder('UTF-8')('ignore')
+        pending = ''
+        chunks = iter(ChannelReader(self._channel))
+        while True:
+            data = next(chunks, b'')
+            pending += decoder.decode(data, final=not data)
+            lines = pending.split('\n')
+            pending = lines.pop()
+            for line in lines:
+                for piece in self._split(line.rstrip('\r')):
+                    yield piece
+            while len(pending) > self._max_line_length:
+                line = pending[:self._max_line_length]
+                pending = pending[self._max_line_length:]
+                LOG.debug(line, extra={'host': self._ssh_client._hostname})
+                yield line
+            if not data:
+                break
+        if pending:
+            for piece in self._split(pending):
+                yield piece
+        self.exit_status = self._channel.recv_exit_status()
+        self._channel.close()
+        self._ssh_client._evaluate_run_result(
+            self.exit_status, None, ignore_error=self._ignore_error,
+            success_status=self._success_status,
+            custom_log=self._custom_log)
+
+
+class ShellSession(object):
+    """A long-lived bash process that runs commands on demand.
+
+    The commands are written on the standard input of the shell, each one is
+    followed by a sentinel line that carries its exit status.
+    """
+    def __init__(self, transport, hostname):
+        self._hostname = hostname
+        self._channel = transport.open_session()
+        self._channel.set_combine_stderr(True)
+        self._channel.exec_command('/bin/bash --noprofile --norc')
+        self._chunks = iter(ChannelReader(self._channel))
+        self._buffer = b''
+        self._sourced = []
+        self.closed = False
+
+    def source(self, filename):
+        """Source an environment file in the shell, once."""
+        if filename in self._sourced:
+            return
+        output, exit_status = self.run('. %s' % filename, subshell=False)
+        if exit_status != 0:
+            raise ssh_exception.SSHException(
+                'failed to source %s: %s' % (filename, output))
+        self._sourced.append(filename)
+
+    def run(self, cmd, subshell=True):
+        """Run a command in the shell.
+
+        :return: the tuple (output of the command, returned code)
+        """
+        sentinel = '__tripleohelper_%s__' % uuid.uuid4().hex
+        if subshell:
+            cmd = '(\n%s\n) < /dev/null' % cmd
+        self._channel.sendall(
+            ('%s\nprintf "\\n%s %%d\\n" $?\n' % (cmd, sentinel)).encode('UTF-8'))
+        marker = ('\n%s ' % sentinel).encode('UTF-8')
+        while True:
+            position = self._buffer.find(marker)
+            end = self._buffer.find(b'\n', position + len(marker))
+            if position != -1 and end != -1:
+                break
+            data = next(self._chunks, b'')
+            if not data:
+                self.closed = True
+                raise ssh_exception.SSHException('the remote shell has exited')
+            LOG.debug(data.decode('UTF-8', 'ignore').strip(),
+                      extra={'host': self._hostname})
+            self._buffer += data
+        output = self._buffer[:position].decode('UTF-8', 'ignore')
+        exit_status = int(self._buffer[position + len(marker):end])
+        self._buffer = self._buffer[end + 1:]
+        return output, exit_status
+
+    def close(self):
+        self.closed = True
+        self._channel.close()
+
+
+class BastionRegistry(object):
+    """Share the connections to the SSH bastions.
+
+    The clients that reach their host through the same bastion (via_ip) open
+    their direct-tcpip channels on a single authenticated transport. The
+    connection is reference counted: it's closed once the last client has
+    released it, and reopened if it has died in the meantime.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bastions = {}
+
+    def _connect(self, key):
+        via_ip, port, user, key_filename = key
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(via_ip, port=port, username=user, allow_agent=True,
+                       pkey=PRIVATE_KEYS.load(key_filename))
+        client.get_transport().set_keepalive(10)
+        set_nodelay(client.get_transport())
+        LOG.debug('[%s@%s] bastion connected' % (user, via_ip))
+        return client
+
+    def acquire(self, key):
+        """Take a reference on a bastion connection, open it if needed.
+
+        :param key: the (via_ip, port, user, key_filename) tuple
+        """
+        with self._lock:
+            bastion = self._bastions.get(key)
+            if bastion is None:
+                bastion = {'client': self._connect(key), 'refcount': 0}
+                self._bastions[key] = bastion
+            bastion['refcount'] += 1
+
+    def release(self, key):
+        """Drop a reference, the last one closes the bastion connection."""
+        with self._lock:
+            bastion = self._bastions[key]
+            bastion['refcount'] -= 1
+            if bastion['refcount'] == 0:
+                bastion['client'].close()
+                del self._bastions[key]
+
+    def get_transport(self, key):
+        """Return the transport of an acquired bastion, reconnect if needed."""
+        with self._lock:
+            bastion = self._bastions[key]
+            transport = bastion['client'].get_transport()
+            if transport is None or not transport.is_active():
+                LOG.info('[%s@%s] bastion connection lost, reconnecting' % (
+                    key[2], key[0]))
+                bastion['client'].close()
+                bastion['client'] = self._connect(key)
+                transport = bastion['client'].get_transport()
+            return transport
+
+    def refcount(self, key):
+        with self._lock:
+            return self._bastions[key]['refcount'] if key in self._bastions else 0
+
+
+def backoff(timeout, initial_delay=.5, max_delay=10):
+    """Iterate over the attempts of an operation until a deadline.
+
+    Each iteration is an attempt, the caller breaks out of the loop on
+    success. Between two attempts, the generator sleeps an exponentially
+    growing delay, with some jitter to not synchronize the clients that
+    wait for the same hosts. There is always at least one attempt.
+
+    :param timeout: the number of seconds after which no new attempt is made
+    :param initial_delay: the delay before the second attempt
+    :param max_delay: the upper bound of the delay between two attempts
+    """
+    deadline = time.time() + timeout
+    delay = initial_delay
+    attempt = 0
+    while True:
+        yield attempt
+        attempt += 1
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        time.sleep(min(remaining, delay * random.uniform(.5, 1)))
+        delay = min(max_delay, delay * 2)
+
+
+def tcp_probe(hostname, port, timeout=5):
+    """Check that a TCP port accepts connections.
+
+    It is much cheaper than a failed SSH handshake and it fails fast
+    while a host is booting.
+    """
+    sock = socket.create_connection((hostname, port), timeout=timeout)
+    sock.close()
+
+
+def set_nodelay(transport):
+    """Send the packets of a transport without waiting for the ACKs.
+
+    A command is a handful of small packets each way: with Nagle's
+    algorithm, each of them waits for the delayed ACK of the previous one,
+    about 40ms. The transports tunnelled in a channel are skipped, the
+    socket of their bastion carries the packets.
+    """
+    if isinstance(transport.sock, socket.socket):
+        transport.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+# All the SshClient of the process share this registry.
+BASTIONS = BastionRegistry()
+
+
+class PrivateKeyCache(object):
+    """Parse each private key file only once.
+
+    The keys are indexed by path and modification time, a file rewritten
+    in place is parsed again. The key type is auto-detected, Ed25519 first
+    since it is the cheapest one to sign the handshakes with.
+    """
+    # Ed25519Key requires paramiko 2.2
+    key_classes = tuple(
+        getattr(paramiko, name) for name in ('Ed25519Key', 'ECDSAKey', 'RSAKey')
+        if hasattr(paramiko, name))
+
+    def __init__(self):
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def _parse(self, path):
+        for key_class in self.key_classes:
+            try:
+                return key_class.from_private_key_file(path)
+            except ssh_exception.SSHException:
+                continue
+        raise ssh_exception.SSHException(
+            'unsupported private key type: %s' % path)
+
+    def load(self, path):
+        """Return the key of a private key file, None if path is None."""
+        if path is None:
+            return None
+        cache_key = (os.path.abspath(path), os.path.getmtime(path))
+        with self._lock:
+            key = self._keys.get(cache_key)
+            if key is None:
+                LOG.debug('loading the private key %s' % path)
+                key = self._parse(path)
+                self._keys[cache_key] = key
+        return key
+
+
+# All the SshClient of the process share this cache.
+PRIVATE_KEYS = PrivateKeyCache()
+
 
 class SshClient(object):
     """SSH client based on Paramiko.
@@ -39,7 +512,7 @@ class SshClient(object):
         - create remote files
     """
     def __init__(self, hostname, user, key_filename=None,
-                 via_ip=None):
+                 via_ip=None, port=22):
         """:param hostname: the host on which to connect
         :type hostname: str
         :param user: the user to use for the connection
@@ -50,42 +523,54 @@ class SshClient(object):
         :param redirect_to_host: the host on which to redirect, by default it
         will use the port 22
         :type redirect_to_host: str
+        :param port: the port of the ssh services, on the host and on the
+        bastion
+        :type port: int
         """
         assert hostname, 'hostname is defined.'
         assert user, 'user is defined.'
         self._hostname = hostname
         self._user = user
         self._key_filename = key_filename
+        self._port = port
         self.load_private_key(key_filename)
         self._client = paramiko.SSHClient()
         self._client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         self.via_ip = via_ip
+        self._bastion = None
         self._transport = None
+        self._sftp = None
+        self._sftp_lock = threading.Lock()
+        # the number of SFTP sessions opened, for instrumentation purpose
+        self.sftp_session_count = 0
+        self._shell_session = None
+        self._shell_session_enabled = False
+        self._shell_session_lock = threading.Lock()
         self._started = False
+        self._reconnect_lock = threading.Lock()
+        self._probe_lock = threading.Lock()
+        self._last_probe = 0
         self.description = 'not started yet'
         self._environment_filenames = []
+        self._environment = None
+        self._environment_snapshot_enabled = False
+        self._environment_lock = threading.Lock()
 
     def load_private_key(self, priv_key):
         """Register the SSH private key."""
-        with open(priv_key) as fd:
-            self._private_key = paramiko.RSAKey.from_private_key(fd)
+        self._private_key = PRIVATE_KEYS.load(priv_key)
 
     def _get_transport_via_ip(self):
-        for i in range(60):
-            try:
-                channel = self._client.get_transport().open_channel(
-                    'direct-tcpip',
-                    (self._hostname, 22),
-                    (self.via_ip, 0))
-            except ssh_exception.ChannelException:
-                LOG.debug('%s creating the direct-tcip connections' % self.description)
-                time.sleep(1)
-            else:
-                transport = paramiko.Transport(channel)
-                transport.start_client()
-                transport.auth_publickey(self._user, self._private_key)
-                return transport
-        raise Exception()
+        # the bastion fails to open the channel while the host is not
+        # reachable, this is our TCP probe
+        channel = BASTIONS.get_transport(self._bastion).open_channel(
+            'direct-tcpip',
+            (self._hostname, self._port),
+            (self.via_ip, 0))
+        transport = paramiko.Transport(channel)
+        transport.start_client()
+        transport.auth_publickey(self._user, self._private_key)
+        return transport
 
     def _get_transport(self):
         if self.via_ip:
@@ -93,15 +578,22 @@ class SshClient(object):
         else:
             transport = self._client.get_transport()
         transport.set_keepalive(10)
+        set_nodelay(transport)
         return transport
 
-    def start(self):
+    def start(self, timeout=None):
         """Start the ssh client and connect to the host.
 
-        It will wait until the ssh service is available during 90 seconds.
-        If it doesn't succed to connect then the function will raise
-        an SSHException.
+        It will wait until the ssh service is available, by default during
+        90 seconds. If it doesn't succed to connect then the function will
+        raise the last connection error.
+
+        :param timeout: the number of seconds to wait for the ssh service,
+        DEFAULT_CONNECT_TIMEOUT by default
+        :type timeout: int
         """
+        if timeout is None:
+            timeout = DEFAULT_CONNECT_TIMEOUT
         if self.via_ip:
             connect_to = self.via_ip
             self.description = '[%s@%s via %s]' % (self._user,
@@ -112,56 +604,319 @@ class SshClient(object):
             self.description = '[%s@%s]' % (self._user,
                                             self._hostname)
 
+        self._close_sftp()
+        with self._measure('connect', connect_to):
+            try:
+                self._connect(connect_to, timeout)
+            except Exception:
+                # the next start() acquires the bastion again
+                if self._bastion is not None:
+                    BASTIONS.release(self._bastion)
+                    self._bastion = None
+                raise
+
+    def _connect(self, connect_to, timeout):
         exception = None
-        for i in range(60):
+        for attempt in backoff(timeout):
             try:
-                self._client.connect(
-                    connect_to,
-                    username=self._user,
-                    allow_agent=True,
-                    key_filename=self._key_filename)
+                if not self.via_ip:
+                    tcp_probe(connect_to, self._port)
+                    self._client.connect(
+                        connect_to,
+                        port=self._port,
+                        username=self._user,
+                        allow_agent=True,
+                        pkey=self._private_key)
+                elif self._bastion is None:
+                    tcp_probe(connect_to, self._port)
+                    bastion = (self.via_ip, self._port, self._user,
+                               self._key_filename)
+                    BASTIONS.acquire(bastion)
+                    self._bastion = bastion
             # NOTE(Gonéri): TypeError is in the list because of
             # https://github.com/paramiko/paramiko/issues/615
                 self._transport = self._get_transport()
             except (OSError,
+                    socket.error,
                     TypeError,
                     ssh_exception.SSHException,
                     ssh_exception.NoValidConnectionsError) as e:
                 exception = e
-                LOG.info('%s waiting for %s: %s' %
-                         (self.description, connect_to, str(exception)))
-                time.sleep(1)
+                # only the first failure is worth the info level
+                log = LOG.info if attempt == 0 else LOG.debug
+                log('%s waiting for %s: %s' %
+                    (self.description, connect_to, str(exception)),
+                    extra={'host': self._hostname})
             else:
-                LOG.debug('%s connected' % self.description)
+                LOG.debug('%s connected' % self.description,
+                          extra={'host': self._hostname})
                 self._started = True
+                self._last_probe = time.time()
                 return
 
         _error = ("unable to connect to ssh service on '%s': %s" %
                   (self._hostname, str(exception)))
-        LOG.error(_error)
+        LOG.error(_error, extra={'host': self._hostname})
         raise exception
 
     def _check_started(self):
         if not self._started:
             _error = "ssh client not started, please start the client"
-            LOG.error(_error)
+            LOG.error(_error, extra={'host': self._hostname})
             raise ssh_exception.SSHException(_error)
+        if not self.is_alive():
+            self._reconnect()
+        elif time.time() - self._last_probe >= PROBE_INTERVAL:
+            if not self.probe():
+                self._reconnect()
+
+    def is_alive(self):
+        """Tell if the transport is still active, without network traffic.
+
+        The keepalive the transports send every 10 seconds does not expect
+        an answer: a peer that stopped answering is only detected once TCP
+        gives up, after several minutes. See probe().
+        """
+        if not self._started or self._transport is None:
+            return False
+        return self._transport.is_active()
+
+    def probe(self, timeout=None):
+        """Tell if the peer answers a request within timeout seconds.
+
+        The request is a global request the peer has to answer, even to
+        decline it. The transport of a peer that does not answer in time is
+        closed, the next operation reconnects.
+
+        :param timeout: the number of seconds to wait for the answer,
+        DEFAULT_PROBE_TIMEOUT by default
+        :type timeout: int
+        """
+        if timeout is None:
+            timeout = DEFAULT_PROBE_TIMEOUT
+        if not self.is_alive():
+            return False
+        transport = self._transport
+        with self._probe_lock:
+            # global_request() has no timeout, it returns once the
+            # transport is closed
+            thread = threading.Thread(target=transport.global_request,
+                                      args=('keepalive@openssh.com',))
+            thread.daemon = True
+            thread.start()
+            thread.join(timeout)
+            if thread.is_alive():
+                LOG.warning('%s no answer after %d seconds' % (
+                    self.description, timeout), extra={'host': self._hostname})
+                transport.close()
+                return False
+            self._last_probe = time.time()
+        return transport.is_active()
+
+    def _reconnect(self):
+        with self._reconnect_lock:
+            if self.is_alive():
+                return
+            LOG.warning('%s connection lost, reconnecting' % self.description,
+                        extra={'host': self._hostname})
+            self.stop()
+            self.start()
+
+    def wait_for_reboot(self, boot_id, timeout=None):
+        """Wait for the host to reboot and reconnect to it.
+
+        The host is considered rebooted once its boot id differs from
+        boot_id, see read_boot_id(). Until then, the client reconnects as
+        soon as the ssh service answers, with the back off of start().
+
+        A host that hangs while it shuts down can block a connection or a
+        command forever: the connection is closed at the deadline, so the
+        wait never lasts much longer than timeout.
+
+        :param boot_id: the boot id of the host before the reboot
+        :param timeout: the number of seconds to wait, DEFAULT_REBOOT_TIMEOUT
+        by default
+        """
+        if timeout is None:
+            timeout = DEFAULT_REBOOT_TIMEOUT
+        deadline = time.time() + timeout
+
+        def interrupt():
+            if self._transport is not None:
+                self._transport.close()
+            self._client.close()
+        watchdog = threading.Timer(timeout, interrupt)
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            for attempt in backoff(timeout, initial_delay=1, max_delay=5):
+                self.stop()
+                try:
+                    self.start(timeout=max(0, deadline - time.time()))
+                    if self.read_boot_id() != boot_id:
+                        LOG.info('%s rebooted' % self.description,
+                                 extra={'host': self._hostname})
+                        return
+                # NOTE(Gonéri): TypeError is in the list because of
+                # https://github.com/paramiko/paramiko/issues/615
+                except (OSError,
+                        socket.error,
+                        EOFError,
+                        TypeError,
+                        ssh_exception.SSHException,
+                        ssh_exception.NoValidConnectionsError) as e:
+                    LOG.debug('%s waiting for the reboot: %s' % (
+                        self.description, e), extra={'host': self._hostname})
+        finally:
+            watchdog.cancel()
+        _error = '%s has not rebooted after %d seconds' % (
+            self.description, timeout)
+        LOG.error(_error, extra={'host': self._hostname})
+        raise ssh_exception.SSHException(_error)
+
+    def read_boot_id(self):
+        """Return the boot id, a random id the kernel draws at each boot."""
+        return self.run('cat /proc/sys/kernel/random/boot_id')[0]
 
     def stop(self):
         """Close the ssh connection."""
         self._started = False
+        self._close_sftp()
+        self._close_shell_session()
+        if self._bastion is not None:
+            if self._transport is not None:
+                self._transport.close()
+            BASTIONS.release(self._bastion)
+            self._bastion = None
         self._client.close()
 
     def _prepare_cmd(self, cmd, sudo=False):
         if sudo:
             cmd = "sudo %s" % cmd
-        else:
+        elif self._get_environment() is None:
             for filename in self._environment_filenames:
                 cmd = '. %s; %s' % (filename, cmd)
         return cmd
 
+    def _environment_prefix(self, sudo=False):
+        """The statement that restores the environment snapshot.
+
+        The snapshot is sourced from a remote file: the rc files usually
+        hold a password, the variables are kept out of the command lines
+        the other users of the host can read.
+        """
+        if sudo or not self._get_environment():
+            return ''
+        return '. %s; ' % quote(self._environment_path())
+
+    def _environment_path(self):
+        """The remote file of the snapshot, relative to the home directory.
+
+        Its name depends on the environment files, the clients that source
+        the same files share it.
+        """
+        digest = hashlib.sha1(
+            '\0'.join(self._environment_filenames).encode('UTF-8'))
+        return '.tripleohelper-environment-%s' % digest.hexdigest()[:12]
+
+    def _get_environment(self):
+        """The variables set by the environment files, or None.
+
+        None means the files have to be sourced before the command, because
+        the snapshot is disabled or because it cannot be captured.
+        """
+        if not self._environment_snapshot_enabled:
+            return None
+        if not self._environment_filenames:
+            return None
+        with self._environment_lock:
+            if self._environment is None:
+                self._environment = self._capture_environment()
+        return self._environment or None
+
+    def _capture_environment(self):
+        # the files are sourced in the order _prepare_cmd uses, what they
+        # print must not be mixed with the variables
+        sources = ''.join('. %s >/dev/null 2>&1 && ' % f
+                          for f in reversed(self._environment_filenames))
+        sentinel = '__tripleohelper_%s__' % uuid.uuid4().hex
+        cmd = "env -0 && printf '%s\\0' && %senv -0" % (sentinel, sources)
+        LOG.info("%s capture the environment of %s" % (
+            self.description, ', '.join(self._environment_filenames)),
+            extra={'host': self._hostname})
+        channel = self._transport.open_session()
+        channel.exec_command(cmd)
+        output = b''.join(ChannelReader(channel))
+        exit_status = channel.recv_exit_status()
+        channel.close()
+        if exit_status != 0:
+            LOG.warning('%s failed to capture the environment, the files '
+                        'will be sourced before each command' % self.description,
+                        extra={'host': self._hostname})
+            return False
+
+        def parse(entries):
+            variables = {}
+            for entry in entries:
+                key, _, value = entry.decode('UTF-8', 'ignore').partition('=')
+                if key:
+                    variables[key] = value
+            return variables
+        entries = output.split(b'\0')
+        separator = entries.index(sentinel.encode('UTF-8'))
+        before = parse(entries[:separator])
+        after = parse(entries[separator + 1:])
+        environment = dict(
+            (k, v) for k, v in after.items()
+            if before.get(k) != v and k not in ('_', 'SHLVL', 'PWD', 'OLDPWD'))
+        # what is not a variable, like the functions bash exports
+        for key in [k for k in environment if not ENVIRONMENT_NAME.match(k)]:
+            del environment[key]
+        if environment and not self._write_environment(environment):
+            return False
+        return environment
+
+    def _write_environment(self, environment):
+        """Write the snapshot in a remote file only the user can read.
+
+        The content is sent on the standard input, not on the command line.
+        """
+        path = quote(self._environment_path())
+        content = ''.join('export %s=%s\n' % (k, quote(v))
+                          for k, v in sorted(environment.items()))
+        channel = self._transport.open_session()
+        channel.set_combine_stderr(True)
+        channel.exec_command(
+            'umask 077 && cat > %s.$$ && mv -f %s.$$ %s' % (path, path, path))
+        channel.sendall(content.encode('UTF-8'))
+        channel.shutdown_write()
+        output = b''.join(ChannelReader(channel)).decode('UTF-8', 'ignore')
+        exit_status = channel.recv_exit_status()
+        channel.close()
+        if exit_status != 0:
+            LOG.warning('%s failed to write the environment, the files will '
+                        'be sourced before each command: %s' % (
+                            self.description, output.strip()),
+                        extra={'host': self._hostname})
+            return False
+        return True
+
+    def enable_environment_snapshot(self, enabled=True):
+        """Source the environment files once instead of before each command.
+
+        The variables the files set are captured the first time a command
+        is run and written in a remote file, only readable by the user. The
+        following commands source this file, they no longer fork a shell to
+        re-read the environment files. The snapshot is taken again
+        if an environment file is added. Like before, the commands run
+        with sudo do not get the environment.
+        """
+        with self._environment_lock:
+            self._environment_snapshot_enabled = enabled
+            self._environment = None
+
     def run(self, cmd, sudo=False, ignore_error=False, success_status=(0,),
-            error_callback=None, custom_log=None, retry=0):
+            error_callback=None, custom_log=None, retry=0, capture=None):
         """Run a command on the remote host.
 
         The command is run on the remote host, if there is a redirected host
@@ -182,35 +937,41 @@ class SshClient(object):
         :param custom_log: a optional string to record in the log instead of the command.
         This is useful for example if you want to hide a password.
         :type custom_log: str
+        :param capture: an optional CapturePolicy, to bound the memory used
+        by a command with a huge output. Such a command does not use the
+        shell session, it runs in its own channel with a pseudo terminal.
+        :type capture: CapturePolicy
         """
         self._check_started()
-        cmd_output = io.StringIO()
-        channel = self._get_channel()
-        cmd = self._prepare_cmd(cmd, sudo=sudo)
+        # the shell session keeps the whole output in memory
+        in_session = self._shell_session_enabled and not capture
+        if in_session:
+            prepared_cmd = "sudo %s" % cmd if sudo else cmd
+        else:
+            prepared_cmd = self._prepare_cmd(cmd, sudo=sudo)
 
         if not custom_log:
-            custom_log = cmd
-        LOG.info("%s run '%s'" % (self.description, custom_log))
-        channel.exec_command(cmd)
-
-        while True:
-            received = None
-            rl, _, _ = select.select([channel], [], [], 30)
-            if rl:
-                received = channel.recv(1024).decode('UTF-8', 'ignore').strip()
-                if received:
-                    LOG.debug(received)
-                    cmd_output.write(received)
-            if channel.exit_status_ready() and not received:
-                break
-        cmd_output = cmd_output.getvalue()
-        exit_status = channel.exit_status
+            custom_log = prepared_cmd
+        LOG.info("%s run '%s'" % (self.description, custom_log),
+                 extra={'host': self._hostname})
         try:
+            # a connection lost during the command is retried like a
+            # failure of the command, the caller tells with retry that the
+            # command is idempotent
+            with self._measure('run', custom_log) as measure:
+                if in_session:
+                    cmd_output, exit_status = self._run_in_shell_session(prepared_cmd)
+                else:
+                    cmd_output, exit_status = self._run_in_channel(
+                        self._environment_prefix(sudo) + prepared_cmd,
+                        capture=capture)
+                measure['size'] = getattr(cmd_output, 'size', len(cmd_output))
             return self._evaluate_run_result(
                 exit_status, cmd_output, ignore_error=ignore_error,
                 success_status=success_status, error_callback=error_callback,
                 custom_log=custom_log)
-        except (paramiko.ssh_exception.SSHException, socket.error) as e:
+        except (paramiko.ssh_exception.SSHException, socket.error,
+                EOFError) as e:
             if not retry:
                 raise e
             else:
@@ -218,7 +979,213 @@ class SshClient(object):
                     cmd, sudo=sudo, ignore_error=ignore_error,
                     success_status=success_status,
                     error_callback=error_callback, custom_log=custom_log,
-                    retry=(retry - 1))
+                    retry=(retry - 1), capture=capture)
+
+    def query(self, cmd, sudo=False, ignore_error=False, success_status=(0,),
+              custom_log=None):
+        """Run a command whose output is meant to be parsed.
+
+        Unlike run(), there is no pseudo terminal: the tools do not page
+        or colorize their output, no carriage return is added, and the
+        standard output and error are kept apart. The outputs are returned
+        raw, as bytes.
+
+        :param cmd: the command to run
+        :type cmd: str
+        :param sudo: True if the command should be run with sudo
+        :type sudo: str
+        :param success_status: the list of the possible success status
+        :type success_status: list
+        :param custom_log: a optional string to record in the log instead of the command.
+        :type custom_log: str
+        :return: the tuple (stdout, stderr, returned code)
+        :rtype: tuple
+        """
+        self._check_started()
+        prepared_cmd = self._prepare_cmd(cmd, sudo=sudo)
+        if not custom_log:
+            custom_log = prepared_cmd
+        LOG.info("%s query '%s'" % (self.description, custom_log),
+                 extra={'host': self._hostname})
+        with self._measure('query', custom_log) as measure:
+            channel = self._get_channel(pty=False)
+            channel.exec_command(self._environment_prefix(sudo) + prepared_cmd)
+            stderr = []
+            stdout = b''.join(ChannelReader(channel, stderr=stderr))
+            stderr = b''.join(stderr)
+            exit_status = channel.recv_exit_status()
+            channel.close()
+            measure['size'] = len(stdout) + len(stderr)
+        if stderr.strip():
+            LOG.debug(stderr.decode('UTF-8', 'ignore').strip(),
+                      extra={'host': self._hostname})
+        self._evaluate_run_result(
+            exit_status, stdout, ignore_error=ignore_error,
+            success_status=success_status, custom_log=custom_log)
+        return stdout, stderr, exit_status
+
+    def run_many(self, commands):
+        """Run a list of commands in a single round trip.
+
+        The commands are sent as one script and run one after the other.
+        Like with a sequence of run() calls, the script stops at the first
+        failing command, unless this one has ignore_error or an
+        error_callback.
+
+        :param commands: a list of commands, each one is either a string or
+        a dict with a 'cmd' key and optionally the 'sudo', 'ignore_error',
+        'success_status', 'error_callback' and 'custom_log' keys of run().
+        :type commands: list
+        :return: a CommandResult per command
+        :rtype: list
+        """
+        self._check_started()
+        commands = [dict(c) if isinstance(c, dict) else {'cmd': c}
+                    for c in commands]
+        sentinel = '__tripleohelper_%s__' % uuid.uuid4().hex
+        script = ''
+        for command in commands:
+            command.setdefault('success_status', (0,))
+            prepared_cmd = self._prepare_cmd(
+                command['cmd'], sudo=command.get('sudo', False))
+            if not command.get('custom_log'):
+                command['custom_log'] = prepared_cmd
+            prefix = self._environment_prefix(command.get('sudo', False))
+            script += (
+                'start=$(date +%%s.%%N)\n'
+                '(\n%s%s\n) < /dev/null 2>&1\n'
+                'rc=$?\n'
+                'printf "\\n%s %%d %%s %%s\\n" $rc $start $(date +%%s.%%N)\n'
+            ) % (prefix, prepared_cmd, sentinel)
+            if not (command.get('ignore_error') or command.get('error_callback')):
+                script += 'case $rc in %s) ;; *) exit 0;; esac\n' % '|'.join(
+                    str(status) for status in command['success_status'])
+        LOG.info("%s run a batch of %d commands: %s" % (
+            self.description, len(commands),
+            ', '.join("'%s'" % c['custom_log'] for c in commands)),
+            extra={'host': self._hostname})
+
+        channel = self._transport.open_session()
+        channel.set_combine_stderr(True)
+        channel.exec_command('/bin/bash -s')
+        channel.sendall(script.encode('UTF-8'))
+        channel.shutdown_write()
+        output = b''.join(ChannelReader(channel)).decode('UTF-8', 'ignore')
+        channel.recv_exit_status()
+        channel.close()
+
+        results = []
+        position = 0
+        pattern = re.compile(r'\n%s (\d+) ([\d.]+) ([\d.]+)\n' % sentinel)
+        for command, match in zip(commands, pattern.finditer(output)):
+            cmd_output = output[position:match.start()].strip()
+            position = match.end()
+            if cmd_output:
+                LOG.debug(cmd_output, extra={'host': self._hostname})
+            result = CommandResult(
+                command['cmd'], cmd_output, int(match.group(1)),
+                float(match.group(3)) - float(match.group(2)))
+            results.append(result)
+            self._evaluate_run_result(
+                result.exit_status, result.output,
+                ignore_error=command.get('ignore_error', False),
+                success_status=command['success_status'],
+                error_callback=command.get('error_callback'),
+                custom_log=command['custom_log'])
+        if len(results) < len(commands):
+            _error = ("%s batch interrupted before the command %s" %
+                      (self.description, commands[len(results)]['custom_log']))
+            LOG.error(_error, extra={'host': self._hostname})
+            raise ssh_exception.SSHException(_error)
+        return results
+
+    def _run_in_channel(self, cmd, capture=None):
+        cmd_output = capture.open() if capture else io.StringIO()
+        channel = self._get_channel()
+        channel.exec_command(cmd)
+
+        decoder = codecs.getincrementaldecoder('UTF-8')('ignore')
+        for data in ChannelReader(channel):
+            received = decoder.decode(data)
+            if received.strip():
+                LOG.debug(received.strip(), extra={'host': self._hostname})
+            cmd_output.write(received)
+        cmd_output.write(decoder.decode(b'', final=True))
+        exit_status = channel.recv_exit_status()
+        channel.close()
+        if capture:
+            return cmd_output.getvalue(), exit_status
+        return cmd_output.getvalue().strip(), exit_status
+
+    def _run_in_shell_session(self, cmd):
+        with self._shell_session_lock:
+            if self._shell_session is None or self._shell_session.closed:
+                self._shell_session = ShellSession(self._transport,
+                                                   self._hostname)
+            # the first file added wins, like with _prepare_cmd
+            for filename in reversed(self._environment_filenames):
+                self._shell_session.source(filename)
+            try:
+                cmd_output, exit_status = self._shell_session.run(cmd)
+            except Exception:
+                self._shell_session.close()
+                raise
+        return cmd_output.strip(), exit_status
+
+    def enable_shell_session(self, enabled=True):
+        """Run the commands in a persistent remote shell.
+
+        Instead of a new channel per command, the commands are sent to a
+        single bash process and the environment files are sourced only once.
+        Each command runs in a subshell, so a 'cd' or an 'export' does not
+        leak to the following commands.
+
+        Unlike the commands of run() without the session, the commands have
+        no pseudo terminal, like those of query(): the tools do not page or
+        colorize their output and no carriage return is added. The commands
+        that pass a capture policy to run() do not use the session.
+        """
+        self._shell_session_enabled = enabled
+        if not enabled:
+            self._close_shell_session()
+
+    def _close_shell_session(self):
+        with self._shell_session_lock:
+            if self._shell_session is not None:
+                self._shell_session.close()
+                self._shell_session = None
+
+    def stream(self, cmd, sudo=False, ignore_error=False, success_status=(0,),
+               custom_log=None):
+        """Run a command on the remote host and stream its output.
+
+        Unlike run(), the output is not kept in memory, the lines are
+        yielded as they arrive. The exit status is evaluated once the
+        last line has been consumed.
+
+        :param cmd: the command to run
+        :type cmd: str
+        :param sudo: True if the command should be run with sudo
+        :type sudo: str
+        :param success_status: the list of the possible success status
+        :type success_status: list
+        :param custom_log: a optional string to record in the log instead of the command.
+        :type custom_log: str
+        :return: an iterator over the output lines
+        :rtype: CommandStream
+        """
+        self._check_started()
+        channel = self._get_channel()
+        cmd = self._prepare_cmd(cmd, sudo=sudo)
+
+        if not custom_log:
+            custom_log = cmd
+        LOG.info("%s stream '%s'" % (self.description, custom_log),
+                 extra={'host': self._hostname})
+        channel.exec_command(self._environment_prefix(sudo) + cmd)
+        return CommandStream(self, channel, custom_log,
+                             ignore_error=ignore_error,
+                             success_status=success_status)
 
     def _evaluate_run_result(
             self, exit_status, cmd_output, ignore_error=False, success_status=(0,),
@@ -231,59 +1198,330 @@ class SshClient(object):
         else:
             _error = ("%s command %s has failed with, rc='%s'" %
                       (self.description, custom_log, exit_status))
-            LOG.error(_error)
+            LOG.error(_error, extra={'host': self._hostname})
             raise ssh_exception.SSHException(_error)
 
-    def _get_channel(self):
+    def _get_channel(self, pty=True):
         """Returns a channel according to if there is a redirection to do or
         not.
+
+        :param pty: if False, there is no pseudo terminal and the standard
+        error is not combined with the standard output
         """
         channel = self._transport.open_session()
-        channel.set_combine_stderr(True)
-        channel.get_pty()
+        if pty:
+            channel.set_combine_stderr(True)
+            channel.get_pty()
         return channel
 
-    def send_file(self, local_path, remote_path, unix_mode=None):
+    def _get_sftp(self):
+        """Return the SFTP session of the client, open it on first use."""
+        self._check_started()
+        with self._sftp_lock:
+            if self._sftp is None:
+                self._sftp = paramiko.SFTPClient.from_transport(self._transport)
+                self.sftp_session_count += 1
+            return self._sftp
+
+    def _open_sftp(self):
+        """Open a SFTP session of its own, for a worker thread."""
+        sftp = paramiko.SFTPClient.from_transport(self._transport)
+        with self._sftp_lock:
+            self.sftp_session_count += 1
+        return sftp
+
+    def _close_sftp(self):
+        with self._sftp_lock:
+            if self._sftp is not None:
+                self._sftp.close()
+                self._sftp = None
+
+    def send_file(self, local_path, remote_path, unix_mode=None, delta=False,
+                  parallel=1):
         """Send a file to the remote host.
         :param local_path: the local path of the file
         :type local_path: str
         :param remote_path: the remote path of the file
         :type remote_path: str
-        :return: the file attributes
-        :rtype: paramiko.sftp_attr.SFTPAttributes
+        :param delta: do not send the file if the remote copy is identical
+        :type delta: bool
+        :param parallel: the number of ranges of the file to write
+        concurrently, for the large files. The result is checked with
+        sha256sum.
+        :type parallel: int
         """
-        self._check_started()
-        sftp = paramiko.SFTPClient.from_transport(self._transport)
-        sftp.put(local_path, remote_path)
+        sftp = self._get_sftp()
+        # the small files are not worth the extra sessions
+        min_parallel_size = parallel * self.upload_block_size
+        with self._measure('send_file', remote_path) as measure:
+            if delta and self._remote_sha256(remote_path) == _file_sha256(local_path):
+                LOG.info('%s %s is up to date' % (self.description, remote_path),
+                         extra={'host': self._hostname})
+            elif parallel > 1 and os.path.getsize(local_path) >= min_parallel_size:
+                self._send_file_parallel(local_path, remote_path, parallel)
+                measure['size'] = os.path.getsize(local_path)
+            else:
+                sftp.put(local_path, remote_path)
+                measure['size'] = os.path.getsize(local_path)
         if unix_mode:
             sftp.chmod(remote_path, unix_mode)
 
-    def send_dir(self, local_path, remote_path):
+    # the size of the writes of a parallel upload
+    upload_block_size = 1048576
+
+    def _send_file_parallel(self, local_path, remote_path, parallel):
+        size = os.path.getsize(local_path)
+        LOG.info("%s send '%s' to '%s' in %d ranges" % (
+            self.description, local_path, remote_path, parallel),
+            extra={'host': self._hostname})
+        with self._get_sftp().open(remote_path, 'wb') as f:
+            f.truncate(size)
+        range_size = -(-size // parallel)
+
+        def send_range(source, start):
+            # one SFTP session per range, they cannot be shared between
+            # threads
+            sftp = self._open_sftp()
+            try:
+                with sftp.open(remote_path, 'r+b') as f:
+                    f.set_pipelined(True)
+                    f.seek(start)
+                    end = min(start + range_size, size)
+                    for offset in range(start, end, self.upload_block_size):
+                        f.write(source[offset:min(offset + self.upload_block_size, end)])
+            finally:
+                sftp.close()
+
+        with open(local_path, 'rb') as fd:
+            source = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=parallel + 1) as executor:
+                    # the local checksum is computed during the upload
+                    local_sha256 = executor.submit(_file_sha256, local_path)
+                    gather([executor.submit(send_range, source, start)
+                            for start in range(0, size, range_size)])
+            finally:
+                source.close()
+        if self._remote_sha256(remote_path) != local_sha256.result():
+            _error = '%s checksum mismatch after the upload of %s' % (
+                self.description, remote_path)
+            LOG.error(_error, extra={'host': self._hostname})
+            raise ssh_exception.SSHException(_error)
+
+    def _remote_sha256(self, remote_path):
+        output, exit_status = self.run(
+            'sha256sum %s' % quote(remote_path), ignore_error=True)
+        if exit_status == 0:
+            return output.split()[0]
+
+    def remote_manifest(self, remote_path):
+        """Describe the files of a remote directory, in one command.
+
+        :param remote_path: the path of the directory
+        :return: a dict with the file paths relative to the directory as keys
+        and the (size, sha256) tuples as values.
+        """
+        cmd = (
+            'if cd %s 2>/dev/null; then '
+            'find . -type f -printf "%%s %%P\\n"; echo; '
+            'find . -type f -exec sha256sum {} +; fi'
+        ) % quote(remote_path)
+        output, _ = self.run(cmd)
+        # the PTY turns the \n in \r\n
+        sizes_section, _, sha256sums = output.replace(
+            '\r\n', '\n').partition('\n\n')
+        sizes = {}
+        for line in sizes_section.splitlines():
+            size, _, file_path = line.partition(' ')
+            sizes[file_path] = size
+        manifest = {}
+        for line in sha256sums.splitlines():
+            sha256, _, file_path = line.partition('  ./')
+            if file_path in sizes:
+                manifest[file_path] = (int(sizes[file_path]), sha256)
+        return manifest
+
+    def send_dir(self, local_path, remote_path, use_tar=False,
+                 compression=None, delta=False, delete=False):
         """Send a directory to the remote host.
+
+        By default, the files are copied one by one with SFTP. With use_tar,
+        a tar archive is generated on the fly and piped in a single channel
+        to a remote tar process, this avoids one round trip per file.
+
+        With delta, the local files are compared with the remote ones first
+        and only the files that differ are sent, in a tar stream.
+
         :param local_path: the local path of the directory
         :type local_path: str
         :param remote_path: the remote path of the directory
         :type remote_path: str
-        :return: the file attributes
-        :rtype: paramiko.sftp_attr.SFTPAttributes
+        :param use_tar: stream the directory as a tar archive
+        :type use_tar: bool
+        :param compression: the compression of the tar stream, 'gz', 'bz2'
+        or None
+        :type compression: str
+        :param delta: only send the files that have changed
+        :type delta: bool
+        :param delete: with delta, remove the remote files that do not exist
+        locally
+        :type delete: bool
+        :return: with delta, the lists of the files sent and deleted
+        :rtype: tuple
         """
-        directory, parent = os.path.split(local_path)
-        os.chdir(directory)
-        self._check_started()
-        sftp = paramiko.SFTPClient.from_transport(self._transport)
-        for walker in os.walk(parent):
+        local_path = os.path.normpath(local_path)
+        if delta:
+            return self._send_dir_delta(local_path, remote_path, compression,
+                                        delete)
+        if use_tar:
+            return self._send_dir_tar(local_path, remote_path, compression)
+        directory = os.path.dirname(local_path)
+        sftp = self._get_sftp()
+        for walker in os.walk(local_path):
+            relative_path = os.path.relpath(walker[0], directory)
             try:
-                sftp.mkdir(os.path.join(remote_path, walker[0]))
+                sftp.mkdir(os.path.join(remote_path, relative_path))
             except Exception:
-                LOG.info('directory %s exists' % walker[0])
+                LOG.info('directory %s exists' % relative_path,
+                         extra={'host': self._hostname})
             for file in walker[2]:
                 sftp.put(os.path.join(walker[0], file),
-                         os.path.join(remote_path, walker[0], file))
+                         os.path.join(remote_path, relative_path, file))
+
+    def _send_dir_delta(self, local_path, remote_path, compression=None,
+                        delete=False):
+        name = os.path.basename(local_path)
+        remote_dir = os.path.join(remote_path, name)
+        local = local_manifest(local_path)
+        remote = self.remote_manifest(remote_dir)
+        to_send = sorted(p for p in local if remote.get(p) != local[p])
+        to_delete = sorted(set(remote) - set(local)) if delete else []
+        LOG.info('%s %s: %d files to send, %d to delete, %d up to date' % (
+            self.description, remote_dir, len(to_send), len(to_delete),
+            len(local) - len(to_send)), extra={'host': self._hostname})
+        if to_send:
+            self._send_dir_tar(
+                os.path.dirname(local_path), remote_path, compression,
+                arcnames=[os.path.join(name, p) for p in to_send])
+        if to_delete:
+            self.run('cd %s && rm -f -- %s' % (
+                quote(remote_dir), ' '.join(quote(p) for p in to_delete)))
+        return to_send, to_delete
+
+    def _send_dir_tar(self, local_path, remote_path, compression=None,
+                      arcnames=None):
+        """Pipe a directory to a remote tar process.
+
+        The files belong to the remote user, not to the local uid and gid
+        recorded in the archive.
+
+        :param arcnames: if set, only these files, relative to local_path,
+        are sent.
+        """
+        tar_flags = {None: '', 'gz': 'z', 'bz2': 'j'}[compression]
+        cmd = 'mkdir -p %s && tar x%sf - --no-same-owner -C %s' % (
+            quote(remote_path), tar_flags, quote(remote_path))
+        LOG.info("%s send '%s' to '%s' in a tar stream" % (
+            self.description, local_path, remote_path),
+            extra={'host': self._hostname})
+        self._check_started()
+        channel = self._transport.open_session()
+        channel.set_combine_stderr(True)
+        channel.exec_command(cmd)
+        stdin = channel.makefile('wb')
+        tar = tarfile.open(fileobj=stdin, mode='w|' + (compression or ''),
+                           bufsize=262144)
+        if arcnames is None:
+            tar.add(local_path, arcname=os.path.basename(local_path))
+        else:
+            for arcname in arcnames:
+                tar.add(os.path.join(local_path, arcname), arcname=arcname)
+        tar.close()
+        stdin.close()
+        channel.shutdown_write()
+        output = b''.join(ChannelReader(channel)).decode('UTF-8', 'ignore')
+        exit_status = channel.recv_exit_status()
+        channel.close()
+        return self._evaluate_run_result(exit_status, output, custom_log=cmd)
 
     def open(self, filename, mode='r'):
+        sftp = self._get_sftp()
+        with self._measure('sftp_open', filename):
+            return sftp.open(filename, mode)
+
+    def iter_file(self, remote_path, chunk_size=1048576):
+        """Iterate over the content of a remote file, chunk by chunk.
+
+        The whole file is prefetched: the read requests are pipelined
+        instead of one round trip per 32KiB block.
+
+        :param remote_path: the path of the remote file
+        :param chunk_size: the maximum size of the chunks, in bytes
+        """
+        return self._iter_file(self._get_sftp(), remote_path, chunk_size)
+
+    @staticmethod
+    def _iter_file(sftp, remote_path, chunk_size=1048576):
+        with sftp.open(remote_path, 'rb') as f:
+            f.prefetch()
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+
+    def get_file(self, remote_path, local_path):
+        """Download a remote file.
+
+        The file is written next to local_path and renamed once complete,
+        an interrupted download does not leave a truncated file.
+
+        :return: the size of the file
+        """
+        return self._get_file(self._get_sftp(), remote_path, local_path)
+
+    def _get_file(self, sftp, remote_path, local_path):
+        LOG.info("%s get '%s' to '%s'" % (self.description, remote_path,
+                                          local_path),
+                 extra={'host': self._hostname})
+        size = 0
+        tmp_path = '%s.%s.part' % (local_path, uuid.uuid4().hex)
+        try:
+            with open(tmp_path, 'wb') as fd:
+                for chunk in self._iter_file(sftp, remote_path):
+                    fd.write(chunk)
+                    size += len(chunk)
+            os.rename(tmp_path, local_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return size
+
+    def get_files(self, files, max_workers=4):
+        """Download several remote files in parallel.
+
+        A SFTP session cannot be shared between threads, each worker opens
+        its own one and downloads its share of the files.
+
+        :param files: a list of (remote path, local path) tuples
+        :param max_workers: the number of files downloaded at the same time
+        :return: the list of the file sizes
+        """
         self._check_started()
-        sftp = paramiko.SFTPClient.from_transport(self._transport)
-        return sftp.open(filename, mode)
+        files = list(files)
+        workers = min(max_workers, len(files))
+        if workers < 2:
+            return [self.get_file(remote, local) for remote, local in files]
+
+        def download(indexes):
+            sftp = self._open_sftp()
+            try:
+                return [(i, self._get_file(sftp, files[i][0], files[i][1]))
+                        for i in indexes]
+            finally:
+                sftp.close()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            shares = gather([executor.submit(download, range(w, len(files), workers))
+                             for w in range(workers)])
+        return [size for _, size in sorted(sum(shares, []))]
 
     def create_file(self, path, content, mode='w'):
         """Create a file with a content.
@@ -294,11 +1532,20 @@ class SshClient(object):
         :param mode: the mode of the file while opening it
         :type mode: str
         """
-        self._check_started()
-        sftp = paramiko.SFTPClient.from_transport(self._transport)
-        with sftp.open(path, mode) as remote_file:
-            remote_file.write(content)
-            remote_file.flush()
+        sftp = self._get_sftp()
+        with self._measure('create_file', path, size=len(content)):
+            with sftp.open(path, mode) as remote_file:
+                remote_file.write(content)
+                remote_file.flush()
+
+    @contextlib.contextmanager
+    def _measure(self, kind, label, size=0):
+        """Record the operation in the stats and in the trace."""
+        with trace.TRACER.span('%s %s' % (kind, label), 'ssh',
+                               host=self._hostname, user=self._user):
+            with stats.STATS.measure(kind, self._hostname, self._user,
+                                     label, size=size) as measure:
+                yield measure
 
     def info(self):
         return {'hostname': self._hostname,
@@ -307,12 +1554,45 @@ class SshClient(object):
 
     def add_environment_file(self, filename):
         if filename not in self._environment_filenames:
-            self._environment_filenames.append(filename)
+            with self._environment_lock:
+                self._environment_filenames.append(filename)
+                self._environment = None
+            # the new file has to be sourced before the others
+            self._close_shell_session()
+
+
+def gather(futures, return_exceptions=False):
+    """Wait for a list of futures and return their results.
+
+    :param futures: the futures, as returned by run_async()
+    :param return_exceptions: if True, the exceptions are returned in
+    place of the results, otherwise the first one is raised once all the
+    futures are done.
+    :return: the results, in the order of the futures
+    :rtype: list
+    """
+    concurrent.futures.wait(futures)
+    results = []
+    for future in futures:
+        if future.exception() is None:
+            results.append(future.result())
+        elif return_exceptions:
+            results.append(future.exception())
+        else:
+            raise future.exception()
+    return results
 
 
 class PoolSshClient(object):
-    def __init__(self):
+    def __init__(self, max_sessions=None):
+        """:param max_sessions: the maximum number of commands run_async()
+        runs at the same time on the host.
+        :type max_sessions: int
+        """
         self._ssh_clients = {}
+        self._max_sessions = max_sessions or DEFAULT_MAX_SESSIONS
+        self._executor = None
+        self._executor_lock = threading.Lock()
 
     def build_ssh_client(self, hostname, user, key_filename=None,
                          via_ip=None):
@@ -340,7 +1620,7 @@ class PoolSshClient(object):
 
     def run(self, user, cmd, sudo=False, ignore_error=False,
             success_status=(0,), error_callback=None, custom_log=None,
-            retry=0):
+            retry=0, capture=None):
         self._check_ssh_client(user)
 
         return self._ssh_clients[user].run(
@@ -350,25 +1630,91 @@ class PoolSshClient(object):
             success_status=success_status,
             error_callback=error_callback,
             custom_log=custom_log,
-            retry=retry)
+            retry=retry,
+            capture=capture)
 
-    def send_file(self, user, local_path, remote_path, unix_mode=None):
+    def stream(self, user, cmd, sudo=False, ignore_error=False,
+               success_status=(0,), custom_log=None):
         self._check_ssh_client(user)
-        return self._ssh_clients[user].send_file(local_path, remote_path, unix_mode)
 
-    def send_dir(self, user, local_path, remote_path):
+        return self._ssh_clients[user].stream(
+            cmd,
+            sudo=sudo,
+            ignore_error=ignore_error,
+            success_status=success_status,
+            custom_log=custom_log)
+
+    def run_async(self, user, cmd, sudo=False, ignore_error=False,
+                  success_status=(0,), error_callback=None, custom_log=None,
+                  retry=0, capture=None):
+        """Run a command in the background.
+
+        Each command gets its own channel on the connection of the user.
+
+        :return: the future of the (output, exit status) tuple
+        :rtype: concurrent.futures.Future
+        """
+        self._check_ssh_client(user)
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self._max_sessions)
+        return self._executor.submit(
+            self.run, user, cmd, sudo=sudo, ignore_error=ignore_error,
+            success_status=success_status, error_callback=error_callback,
+            custom_log=custom_log, retry=retry, capture=capture)
+
+    def query(self, user, cmd, sudo=False, ignore_error=False,
+              success_status=(0,), custom_log=None):
+        self._check_ssh_client(user)
+
+        return self._ssh_clients[user].query(
+            cmd, sudo=sudo, ignore_error=ignore_error,
+            success_status=success_status, custom_log=custom_log)
+
+    def run_many(self, user, commands):
+        self._check_ssh_client(user)
+
+        return self._ssh_clients[user].run_many(commands)
+
+    def send_file(self, user, local_path, remote_path, unix_mode=None,
+                  delta=False, parallel=1):
         self._check_ssh_client(user)
-        return self._ssh_clients[user].send_dir(local_path, remote_path)
+        return self._ssh_clients[user].send_file(
+            local_path, remote_path, unix_mode, delta=delta, parallel=parallel)
+
+    def send_dir(self, user, local_path, remote_path, use_tar=False,
+                 compression=None, delta=False, delete=False):
+        self._check_ssh_client(user)
+        return self._ssh_clients[user].send_dir(
+            local_path, remote_path, use_tar=use_tar, compression=compression,
+            delta=delta, delete=delete)
 
     def open(self, user, filename, mode='r'):
         self._check_ssh_client(user)
         return self._ssh_clients[user].open(filename, mode)
 
+    def iter_file(self, user, remote_path, chunk_size=1048576):
+        self._check_ssh_client(user)
+        return self._ssh_clients[user].iter_file(remote_path, chunk_size)
+
+    def get_file(self, user, remote_path, local_path):
+        self._check_ssh_client(user)
+        return self._ssh_clients[user].get_file(remote_path, local_path)
+
+    def get_files(self, user, files, max_workers=4):
+        self._check_ssh_client(user)
+        return self._ssh_clients[user].get_files(files, max_workers)
+
     def create_file(self, user, path, content, mode='w'):
         self._check_ssh_client(user)
         return self._ssh_clients[user].create_file(path, content, mode)
 
     def stop_all(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
         for ssh_client in self._ssh_clients.values():
             ssh_client.stop()
         self._ssh_clients = {}
@@ -377,3 +1723,48 @@ class PoolSshClient(object):
         self._check_ssh_client(user)
 
         self._ssh_clients[user].add_environment_file(filename)
+
+    def enable_shell_session(self, user, enabled=True):
+        self._check_ssh_client(user)
+
+        self._ssh_clients[user].enable_shell_session(enabled)
+
+    def enable_environment_snapshot(self, user, enabled=True):
+        self._check_ssh_client(user)
+
+        self._ssh_clients[user].enable_environment_snapshot(enabled)
+
+    def read_boot_id(self, user):
+        self._check_ssh_client(user)
+
+        return self._ssh_clients[user].read_boot_id()
+
+    def health(self):
+        """Return a dict that tells for each user if its connection is usable.
+
+        Each peer is probed, see SshClient.probe().
+        """
+        return dict((user, ssh_client.probe())
+                    for user, ssh_client in self._ssh_clients.items())
+
+    def reconnect_all(self):
+        """Reconnect the clients whose connection has been lost."""
+        for ssh_client in self._ssh_clients.values():
+            if not ssh_client.probe():
+                ssh_client._reconnect()
+
+    def wait_for_reboot(self, boot_id, timeout=None):
+        """Wait for the host to reboot and reconnect all the clients.
+
+        See SshClient.wait_for_reboot().
+        """
+        ssh_clients = []
+        for ssh_client in self._ssh_clients.values():
+            if ssh_client not in ssh_clients:
+                ssh_clients.append(ssh_client)
+        if not ssh_clients:
+            return
+        ssh_clients[0].wait_for_reboot(boot_id, timeout=timeout)
+        for ssh_client in ssh_clients[1:]:
+            ssh_client.stop()
+            ssh_client.start()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Timing of the remote operations.
+
+The SSH clients record each command, file transfer and connection in the
+STATS collector. At the end of a run, the records are aggregated in
+per-host and per-command histograms and exported as JSON.
+"""
+
+import collections
+import contextlib
+import json
+import threading
+import time
+
+# the upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.01, 0.1, 1, 10, 60, 600)
+
+Record = collections.namedtuple(
+    'Record', ['kind', 'host', 'user', 'label', 'duration', 'size'])
+
+
+def histogram(durations):
+    """Summarize a list of durations.
+
+    :return: a dict with the count, total, min, max, mean and percentiles,
+    plus the number of durations between each bound of BUCKETS and the
+    previous one.
+    """
+    durations = sorted(durations)
+    count = len(durations)
+
+    def percentile(p):
+        return durations[min(count - 1, int(count * p))]
+    buckets = collections.OrderedDict()
+    lower = float('-inf')
+    for bound in BUCKETS:
+        buckets['<=%ss' % bound] = len(
+            [d for d in durations if lower < d <= bound])
+        lower = bound
+    buckets['>%ss' % lower] = len([d for d in durations if d > lower])
+    return {
+        'count': count,
+        'total': sum(durations),
+        'min': durations[0],
+        'max': durations[-1],
+        'mean': sum(durations) / count,
+        'p50': percentile(.5),
+        'p90': percentile(.9),
+        'p99': percentile(.99),
+        'buckets': buckets}
+
+
+class Stats(object):
+    """Collect the timing of the remote operations."""
+    def __init__(self):
+        self._records = []
+        self._lock = threading.Lock()
+
+    def record(self, kind, host, user, label, duration, size=0):
+        """Record an operation.
+
+        :param kind: the type of operation, like 'run' or 'send_file'
+        :param host: the remote host
+        :param user: the remote user
+        :param label: the command or the path, custom_log for the commands
+        :param duration: the duration of the operation, in seconds
+        :param size: the number of bytes transferred
+        """
+        with self._lock:
+            self._records.append(
+                Record(kind, host, user, label, duration, size))
+
+    @contextlib.contextmanager
+    def measure(self, kind, host, user, label, size=0):
+        """Record the duration of a block, even if it raises.
+
+        The block gets a dict whose 'size' key it can update once the
+        number of bytes transferred is known.
+        """
+        start = time.time()
+        measure = {'size': size}
+        try:
+            yield measure
+        finally:
+            self.record(kind, host, user, label, time.time() - start,
+                        measure['size'])
+
+    @property
+    def records(self):
+        with self._lock:
+            return list(self._records)
+
+    def clear(self):
+        with self._lock:
+            self._records = []
+
+    def summary(self):
+        """Aggregate the records in histograms.
+
+        :return: a dict with the 'hosts' and 'commands' keys, the
+        histograms are indexed by host and by "<kind> <label>", and the
+        bytes transferred are summed.
+        """
+        by_host = collections.defaultdict(list)
+        by_command = collections.defaultdict(list)
+        for r in self.records:
+            by_host[r.host].append(r)
+            by_command['%s %s' % (r.kind, r.label)].append(r)
+
+        def aggregate(groups):
+            result = {}
+            for key, records in groups.items():
+                result[key] = histogram([r.duration for r in records])
+                result[key]['bytes'] = sum(r.size for r in records)
+            return result
+        return {'hosts': aggregate(by_host),
+                'commands': aggregate(by_command)}
+
+    def dump(self, path):
+        """Write the summary in a JSON file."""
+        with open(path, 'w') as fd:
+            json.dump(self.summary(), fd, indent=2, sort_keys=True)
+
+
+# All the SshClient of the process record in this collector.
+STATS = Stats()
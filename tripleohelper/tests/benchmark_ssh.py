@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compare the channel readers against the local sshd stand-in.
+
+Usage: python -m tripleohelper.tests.benchmark_ssh [iterations]
+"""
+
+import paramiko
+
+import os
+import select
+import shutil
+import sys
+import tempfile
+import time
+
+import tripleohelper.ssh
+import tripleohelper.tests.sshd
+
+
+def select_reader(channel):
+    """The select/1KiB polling loop SshClient.run used to rely on."""
+    output = []
+    while True:
+        received = None
+        rl, _, _ = select.select([channel], [], [], 30)
+        if rl:
+            received = channel.recv(1024)
+            if received:
+                output.append(received)
+        if channel.exit_status_ready() and not received:
+            break
+    return b''.join(output)
+
+
+def event_reader(channel):
+    return b''.join(tripleohelper.ssh.ChannelReader(channel))
+
+
+def measure(client, reader, cmd, iterations):
+    start = time.time()
+    for _ in range(iterations):
+        channel = client._get_channel()
+        channel.exec_command(cmd)
+        reader(channel)
+        channel.recv_exit_status()
+        channel.close()
+    return (time.time() - start) / iterations
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    root = tempfile.mkdtemp()
+    key_filename = os.path.join(root, 'id_rsa')
+    paramiko.RSAKey.generate(2048).write_private_key_file(key_filename)
+    sshd = tripleohelper.tests.sshd.Sshd(root=root)
+    client = tripleohelper.ssh.SshClient(
+        '127.0.0.1', 'stack', key_filename=key_filename, port=sshd.port)
+    client.start()
+    try:
+        for label, cmd, count in (
+                ('short command', 'true', iterations),
+                ('64MiB output', 'head -c 67108864 /dev/zero', 5)):
+            for name, reader in (('select', select_reader),
+                                 ('event', event_reader)):
+                duration = measure(client, reader, cmd, count)
+                print('%-14s %-7s %9.2f ms/command' % (
+                    label, name, duration * 1000))
+    finally:
+        client.stop()
+        sshd.stop()
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 import copy
+import threading
 
 import tripleohelper.baremetal
 import tripleohelper.host0
@@ -6,9 +7,11 @@ import tripleohelper.ovb_baremetal
 import tripleohelper.ovb_undercloud
 import tripleohelper.server
 import tripleohelper.ssh
+import tripleohelper.tests.sshd
 import tripleohelper.undercloud
 
 import mock
+import paramiko
 import pytest
 
 
@@ -20,21 +23,35 @@ class FakeSshClient(tripleohelper.ssh.SshClient):
             def close(self):
                 pass
         self.hostname = hostname
+        self._hostname = hostname
         self._environment_filenames = []
+        self._environment = None
+        self._environment_snapshot_enabled = False
+        self._environment_lock = threading.Lock()
         self._client = Client()
+        self._bastion = None
+        self._shell_session = None
+        self._shell_session_enabled = False
+        self._shell_session_lock = threading.Lock()
+        self._sftp = None
+        self._sftp_lock = threading.Lock()
+        self._reconnect_lock = threading.Lock()
+        self._probe_lock = threading.Lock()
+        self._last_probe = 0
+        self._transport = None
         self.description = 'not started yet'
 
     def load_private_key(self, f):
         pass
 
-    def start(self):
+    def start(self, timeout=None):
         pass
 
-    def run(self, cmd, **kwargs):
+    def _check_expectation(self, func, cmd, kwargs):
         kwargs['cmd'] = self._prepare_cmd(cmd, sudo=kwargs.get('sudo', False))
         assert FakeSshClient.expectation
         current_expection = FakeSshClient.expectation.pop(0)
-        assert current_expection['func'] == 'run'
+        assert current_expection['func'] == func
 
         # We do not make mandatory to declare in the expectation all the
         # parameters
@@ -44,7 +61,8 @@ class FakeSshClient(tripleohelper.ssh.SshClient):
             'custom_log',
             'success_status',
             'error_callback',
-            'ignore_error')
+            'ignore_error',
+            'capture')
         kwargs_to_compare = {}
         for k, v in kwargs.items():
             if k not in ignore_parameters:
@@ -59,6 +77,23 @@ class FakeSshClient(tripleohelper.ssh.SshClient):
             kwargs.get('success_status', (0,)),
             kwargs.get('error_callback'))
 
+    def run(self, cmd, **kwargs):
+        return self._check_expectation('run', cmd, kwargs)
+
+    def query(self, cmd, **kwargs):
+        cmd_output, exit_status = self._check_expectation('query', cmd, kwargs)
+        return cmd_output.encode(), b'', exit_status
+
+    def run_many(self, commands):
+        results = []
+        for command in commands:
+            kwargs = dict(command)
+            cmd = kwargs.pop('cmd')
+            output, exit_status = self.run(cmd, **kwargs)
+            results.append(tripleohelper.ssh.CommandResult(
+                cmd, output, exit_status, 0))
+        return results
+
     def create_file(self, path, content, mode='w'):
         kwargs = {}
         kwargs['path'] = path
@@ -75,6 +110,9 @@ class FakeSshClient(tripleohelper.ssh.SshClient):
 def fake_sshclient(monkeypatch, request):
     FakeSshClient.expectation = copy.deepcopy(request.param)
     monkeypatch.setattr('tripleohelper.ssh.SshClient', FakeSshClient)
+    # the expectations are ordered, the background commands must run one
+    # at a time
+    monkeypatch.setattr('tripleohelper.ssh.DEFAULT_MAX_SESSIONS', 1)
 
     def fin():
         msg = 'Some expectations remain unevaluated: %s' % FakeSshClient.expectation
@@ -169,3 +207,27 @@ def host0(fake_sshclient):
     s.ssh_pool.add_ssh_client('stack', ssh)
     s.ssh_pool.add_ssh_client('root', ssh)
     return s
+
+
+@pytest.fixture(scope='session')
+def private_key(tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('keys').join('id_rsa'))
+    paramiko.RSAKey.generate(2048).write_private_key_file(path)
+    return path
+
+
+@pytest.fixture
+def sshd(tmpdir):
+    s = tripleohelper.tests.sshd.Sshd(root=str(tmpdir))
+    yield s
+    s.stop()
+
+
+@pytest.fixture
+def ssh_client(sshd, private_key):
+    c = tripleohelper.ssh.SshClient(
+        hostname='127.0.0.1', user='stack', key_filename=private_key,
+        port=sshd.port)
+    c.start()
+    yield c
+    c.stop()
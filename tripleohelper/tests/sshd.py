@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A local SSH server, a stand-in for sshd in the tests and the benchmarks.
+
+The commands are run locally with bash in the root directory of the
+server, the SFTP paths are local paths relative to this root directory. Any
+user and any public key are accepted.
+"""
+
+import paramiko
+
+import logging
+import os
+import socket
+import subprocess
+import threading
+
+# the server side of the transports logs the TCP probes, which close the
+# connection before the SSH banner, as errors with a traceback
+logging.getLogger('tripleohelper.tests.sshd').setLevel(logging.CRITICAL)
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(
+                os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self.filename, attr)
+            return paramiko.SFTP_OK
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class _SFTPServerInterface(paramiko.SFTPServerInterface):
+    def __init__(self, server, *args, **kwargs):
+        self._root = server.sshd.root
+        with server.sshd.lock:
+            server.sshd.sftp_sessions += 1
+        paramiko.SFTPServerInterface.__init__(self, server, *args, **kwargs)
+
+    def _path(self, path):
+        return os.path.join(self._root, path)
+
+    def list_folder(self, path):
+        path = self._path(path)
+        try:
+            entries = []
+            for name in os.listdir(path):
+                attr = paramiko.SFTPAttributes.from_stat(
+                    os.lstat(os.path.join(path, name)))
+                attr.filename = name
+                entries.append(attr)
+            return entries
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        try:
+            binary_flag = getattr(os, 'O_BINARY', 0)
+            fd = os.open(path, flags | binary_flag, attr.st_mode or 0o666)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            fstr = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            fstr = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            fstr = 'rb'
+        handle = _SFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, fstr)
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self._path(oldpath), self._path(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self._path(path), attr)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    def __init__(self, sshd):
+        self.sshd = sshd
+        self.tunnels = {}
+        self.sessions = []
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        with self.sshd.lock:
+            self.sshd.authentications += 1
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.tunnels[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, channel, term, width, height,
+                                  pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        self.sshd.commands.append(command.decode('UTF-8'))
+        thread = threading.Thread(
+            target=self.sshd.execute, args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class Sshd(object):
+    """A SSH server listening on a random port of the loopback interface."""
+    def __init__(self, root):
+        self.root = root
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.commands = []
+        self.lock = threading.Lock()
+        self.sftp_sessions = 0
+        self.authentications = 0
+        self._transports = []
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(100)
+        self.port = self._socket.getsockname()[1]
+        self._thread = threading.Thread(target=self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self._socket.accept()
+            except (OSError, socket.error):
+                return
+            # like sshd for the sessions with a PTY
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            thread = threading.Thread(target=self._serve, args=(sock,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, sock):
+        transport = paramiko.Transport(sock)
+        transport.set_log_channel('tripleohelper.tests.sshd')
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler(
+            'sftp', paramiko.SFTPServer, _SFTPServerInterface)
+        server = _ServerInterface(self)
+        self._transports.append(transport)
+        try:
+            transport.start_server(server=server)
+        except (EOFError, paramiko.SSHException):
+            # a TCP probe, not a SSH client
+            return
+        self._serve_tunnels(transport, server)
+
+    def _serve_tunnels(self, transport, server):
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel is None:
+                continue
+            if channel.get_id() not in server.tunnels:
+                # keep a reference, paramiko closes the garbage collected
+                # channels
+                server.sessions.append(channel)
+                continue
+            sock = socket.create_connection(
+                server.tunnels.pop(channel.get_id()))
+            for src, dest in ((channel, sock), (sock, channel)):
+                thread = threading.Thread(
+                    target=self._forward, args=(src, dest))
+                thread.daemon = True
+                thread.start()
+
+    @staticmethod
+    def _forward(src, dest):
+        try:
+            for data in iter(lambda: src.recv(32768), b''):
+                dest.sendall(data)
+        except (OSError, socket.error, EOFError):
+            pass
+        finally:
+            src.close()
+            dest.close()
+
+    @property
+    def connections(self):
+        """The number of SSH connections authenticated."""
+        return self.authentications
+
+    def execute(self, channel, command):
+        process = subprocess.Popen(
+            command, shell=True, executable='/bin/bash', cwd=self.root,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+
+        def feed_stdin():
+            while True:
+                data = channel.recv(32768)
+                if not data:
+                    break
+                process.stdin.write(data)
+                process.stdin.flush()
+            process.stdin.close()
+
+        def pump_stderr():
+            for data in iter(lambda: os.read(process.stderr.fileno(), 32768), b''):
+                channel.sendall_stderr(data)
+
+        def send_exit_status():
+            # like sshd, report the exit status without waiting for the
+            # background children that may still hold the output open
+            channel.send_exit_status(process.wait())
+
+        threads = [threading.Thread(target=feed_stdin),
+                   threading.Thread(target=pump_stderr),
+                   threading.Thread(target=send_exit_status)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for data in iter(lambda: os.read(process.stdout.fileno(), 32768), b''):
+            channel.sendall(data)
+        threads[1].join()
+        threads[2].join()
+        # the client closes the channel: a close sent from here could
+        # overtake the reply to the exec request, the client would see the
+        # channel closed before the command has started
+        channel.shutdown_write()
+
+    def stop(self):
+        # close() alone does not wake the thread blocked in accept(), the
+        # port would accept one more connection
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except (OSError, socket.error):
+            pass
+        self._socket.close()
+        for transport in self._transports:
+            transport.close()
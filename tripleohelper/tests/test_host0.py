@@ -16,12 +16,16 @@
 
 import pytest
 
+import tripleohelper.image_cache
+import tripleohelper.tests.test_server
+
 
 expectation_build_undercloud = [
     {'func': 'run', 'args': {
         'cmd': 'sysctl net.ipv4.ip_forward=1'}},
-    {'func': 'run', 'args': {
-        'cmd': 'test -f /home/stack/guest_image.qcow2 || curl -L -s -o /home/stack/guest_image.qcow2 http://host/guest_image_path.qcow2'}},
+    {'func': 'run', 'args': {'cmd': tripleohelper.image_cache.command(
+        'http://host/guest_image_path.qcow2', '/home/stack/guest_image.qcow2',
+        writable=True)}},
     {'func': 'run', 'args': {'cmd': 'LIBGUESTFS_BACKEND=direct virt-customize -a /home/stack/guest_image.qcow2 --run-command \'echo MTU="1400" >> /etc/sysconfig/network-scripts/ifcfg-eth0\''}},
     {'func': 'run', 'args': {'cmd': 'mkdir -p /home/stack/DIB'}},
     {'func': 'run', 'args': {'cmd': 'cp -v /etc/yum.repos.d/*.repo /home/stack/DIB'}},
@@ -55,16 +59,18 @@ def test_build_undercloud_on_libvirt(host0):
     assert undercloud.hostname == '192.168.122.234'
 
 
-expectation_deploy_hypervisor = [
+expectation_deploy_hypervisor = tripleohelper.tests.test_server.expectation_package_index + [
     {'func': 'run', 'args': {'cmd': 'yum install -y --quiet libvirt-daemon-driver-nwfilter libvirt-client libvirt-daemon-config-network libvirt-daemon-driver-nodedev libvirt-daemon-kvm libvirt-python libvirt-daemon-config-nwfilter libvirt-glib libvirt-daemon libvirt-daemon-driver-storage libvirt libvirt-daemon-driver-network libvirt-devel libvirt-gobject libvirt-daemon-driver-secret libvirt-daemon-driver-qemu libvirt-daemon-driver-interface libguestfs-tools virt-install genisoimage openstack-tripleo instack-undercloud'}},
     {'func': 'run', 'args': {'cmd': 'sed -i "s,#auth_unix_rw,auth_unix_rw," /etc/libvirt/libvirtd.conf'}},
     {'func': 'run', 'args': {'cmd': 'systemctl start libvirtd'}},
     {'func': 'run', 'args': {'cmd': 'systemctl status libvirtd'}},
-    {'func': 'run', 'args': {'cmd': 'yum install -y --quiet yum-utils iptables libselinux-python psmisc redhat-lsb-core rsync libguestfs-tools'}},
     {'func': 'run', 'args': {'cmd': 'systemctl disable NetworkManager'}},
     {'func': 'run', 'args': {'cmd': 'systemctl stop NetworkManager'}},
     {'func': 'run', 'args': {'cmd': 'pkill -9 dhclient'}},
-    {'func': 'run', 'args': {'cmd': 'yum remove -y --quiet cloud-init NetworkManager'}},
+    # the package index is kept up to date, libguestfs-tools is installed
+    {'func': 'run', 'args': {'cmd': (
+        "yum install -y --quiet yum-utils iptables libselinux-python psmisc redhat-lsb-core rsync && "
+        "yum remove -y --quiet cloud-init NetworkManager")}},
     {'func': 'run', 'args': {'cmd': 'systemctl enable network'}},
     {'func': 'run', 'args': {'cmd': 'systemctl restart network'}},
     {'func': 'run', 'args': {'cmd': 'yum clean all'}},
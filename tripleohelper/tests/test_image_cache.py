@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import os
+import re
+import tarfile
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from paramiko import ssh_exception
+import pytest
+
+import tripleohelper.image_cache
+
+CONTENT = os.urandom(1048576 + 5)
+DIGEST = 'sha256:' + hashlib.sha256(CONTENT).hexdigest()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Serve the content on any path, with the support of the ranges."""
+    content = CONTENT
+
+    def do_HEAD(self):
+        self._send(head=True)
+
+    def do_GET(self):
+        self._send()
+
+    def _send(self, head=False):
+        self.server.requests.append((self.command, self.headers.get('Range')))
+        start, end = 0, len(self.content) - 1
+        match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range') or '')
+        if match:
+            start, end = int(match.group(1)), int(match.group(2))
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if not head:
+            self.wfile.write(self.content[start:end + 1])
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def http_server():
+    server = _Server(('127.0.0.1', 0), _Handler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_image(ssh_client, sshd, http_server, tmpdir):
+    url = 'http://127.0.0.1:%d/overcloud-full.tar' % http_server.server_port
+
+    def fetch(dest, url=url, digest=DIGEST, **kwargs):
+        ssh_client.run(tripleohelper.image_cache.command(
+            url, dest, digest=digest, segment_size=262144, **kwargs))
+
+    # an interrupted download is resumed
+    cache = tmpdir.join(tripleohelper.image_cache.DEFAULT_CACHE_DIR)
+    cache.ensure(dir=True)
+    cache.join(tripleohelper.image_cache.key(url, DIGEST) + '.part.0').write(
+        CONTENT[:1000], mode='wb')
+    fetch('a.tar')
+    assert tmpdir.join('a.tar').read_binary() == CONTENT
+    ranges = sorted(r for c, r in http_server.requests if c == 'GET')
+    assert ranges == ['bytes=1000-262145', 'bytes=262146-524291',
+                      'bytes=524292-786437', 'bytes=786438-1048580']
+
+    # the second destination is a link to the cache entry
+    del http_server.requests[:]
+    fetch('b.tar')
+    assert http_server.requests == []
+    assert os.path.samefile(str(tmpdir.join('a.tar')),
+                            str(tmpdir.join('b.tar')))
+
+    with pytest.raises(ssh_exception.SSHException):
+        fetch('c.tar', digest='sha256:' + '0' * 64)
+    assert not tmpdir.join('c.tar').check()
+
+    # the least recently used entry is evicted
+    fetch('d.tar', url=url + '?v2', cache_size=len(CONTENT))
+    assert not cache.join(tripleohelper.image_cache.key(url, DIGEST)).check()
+    assert cache.join(tripleohelper.image_cache.key(url + '?v2', DIGEST)).check()
+
+
+def test_extract_image(ssh_client, http_server, tmpdir, monkeypatch):
+    source = tmpdir.mkdir('source')
+    source.join('overcloud-full.qcow2').write('qcow2')
+    tarball = tmpdir.join('overcloud-full.tar')
+    with tarfile.open(str(tarball), 'w') as tar:
+        tar.add(str(source.join('overcloud-full.qcow2')),
+                arcname='overcloud-full.qcow2')
+    monkeypatch.setattr(_Handler, 'content', tarball.read_binary())
+    digest = 'sha256:' + hashlib.sha256(_Handler.content).hexdigest()
+    url = 'http://127.0.0.1:%d/overcloud-full.tar' % http_server.server_port
+
+    output, _ = ssh_client.run(
+        tripleohelper.image_cache.extract_command(url, digest=digest))
+    assert tmpdir.join('overcloud-full.qcow2').read() == 'qcow2'
+    assert tripleohelper.image_cache.parse_extraction(output)[:2] == (
+        digest, len(_Handler.content))
+    # the tarball is not stored
+    assert [c for c, _ in http_server.requests] == ['GET']
+
+    with pytest.raises(ssh_exception.SSHException):
+        ssh_client.run(tripleohelper.image_cache.extract_command(
+            url, digest='sha256:' + '0' * 64))
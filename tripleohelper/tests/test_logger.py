@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import gzip
+import logging
+import threading
+import time
+
+import tripleohelper.logger
+
+
+def test_setup_logging(tmpdir):
+    log = logging.getLogger('tripleohelper')
+    tripleohelper.logger.setup_logging(
+        config_file=str(tmpdir.join('chainsaw.log')),
+        host_log_dir=str(tmpdir.join('hosts')))
+    try:
+        log.info('chainsaw started')
+        log.debug('%s run uname -a', '[root@host1]', extra={'host': 'host1'})
+        log.debug('Linux', extra={'host': 'host1'})
+        log.debug('Linux', extra={'host': 'host2'})
+    finally:
+        tripleohelper.logger.stop_logging()
+        for handler in log.handlers[:]:
+            log.removeHandler(handler)
+
+    lines = tmpdir.join('chainsaw.log').read().splitlines()
+    assert [line.split('::')[2] for line in lines] == [
+        'chainsaw started', '[root@host1] run uname -a', 'Linux', 'Linux']
+    with gzip.open(str(tmpdir.join('hosts', 'host1.log.gz'))) as fd:
+        content = fd.read().decode('UTF-8').splitlines()
+    assert [line.split('::')[2] for line in content] == [
+        '[root@host1] run uname -a', 'Linux']
+    assert tmpdir.join('hosts', 'host2.log.gz').check()
+
+
+def test_idle_flush(tmpdir):
+    log = logging.getLogger('tripleohelper')
+    tripleohelper.logger.setup_logging(
+        config_file=str(tmpdir.join('chainsaw.log')))
+    try:
+        log.info('chainsaw started')
+        # written once the queue is idle, without a following record
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            if tmpdir.join('chainsaw.log').read():
+                break
+            time.sleep(.1)
+        assert 'chainsaw started' in tmpdir.join('chainsaw.log').read()
+    finally:
+        tripleohelper.logger.stop_logging()
+    assert not log.handlers
+
+
+def test_blocking_queue_handler():
+    records = tripleohelper.logger.queue.Queue(1)
+    handler = tripleohelper.logger.BlockingQueueHandler(records)
+    thread = threading.Thread(target=lambda: [
+        handler.handle(logging.makeLogRecord({'msg': 'line %d' % i}))
+        for i in range(2)])
+    thread.start()
+    thread.join(.2)
+    # the second record waits for some room in the queue
+    assert thread.is_alive()
+    assert records.get().msg == 'line 0'
+    thread.join()
+    assert records.get().msg == 'line 1'
+
+
+def test_batching_handler(tmpdir):
+    target = logging.FileHandler(str(tmpdir.join('batch.log')))
+    handler = tripleohelper.logger.BatchingHandler(
+        target, capacity=3, interval=3600)
+    for i in range(5):
+        handler.handle(logging.makeLogRecord(
+            {'msg': 'line %d' % i, 'levelno': logging.DEBUG}))
+    # the first batch is written, the last records are buffered
+    assert tmpdir.join('batch.log').read().splitlines() == [
+        'line 0', 'line 1', 'line 2']
+    handler.close()
+    assert len(tmpdir.join('batch.log').read().splitlines()) == 5
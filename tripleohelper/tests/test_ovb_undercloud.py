@@ -30,7 +30,7 @@ expectation_load_instackenv += [
     {'func': 'run', 'args': {'cmd': '. stackrc; jq -M ".nodes|length" /home/stack/instackenv.json'}, 'res': ('0\n', 0)},
     {'func': 'run', 'args': {'cmd': '. stackrc; jq -M ".|length" /home/stack/instackenv.json'}, 'res': ('4\n', 0)},
     {'func': 'run', 'args': {'cmd': '. stackrc; ironic node-list|grep -c "power off"'}, 'res': ('4\n', 0)},
-    {'func': 'run', 'args': {'cmd': ". stackrc; ironic node-list --fields uuid|awk '/-.*-/ {print $2}'"}},
+    {'func': 'query', 'args': {'cmd': ". stackrc; ironic node-list --fields uuid|awk '/-.*-/ {print $2}'"}},
     {'func': 'run', 'args': {'cmd': '. stackrc; openstack baremetal configure boot'}}]
 
 
@@ -14,8 +14,16 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+from paramiko import ssh_exception
 import pytest
 
+import socket
+
+import tripleohelper.facts
+import tripleohelper.image_cache
+import tripleohelper.server
+import tripleohelper.ssh
+
 
 expectation_create_user = [
     {'func': 'run', 'args': {'cmd': 'adduser -m stack'}},
@@ -57,7 +65,14 @@ def test_rhsm_register_with_pool_id(server):
     server.rhsm_register(rhsm={'login': 'login', 'password': 'password', 'pool_id': 'pool_id'})
 
 
-expectation_install_base_packages = [
+# cloud-init and NetworkManager are installed
+expectation_package_index = [
+    {'func': 'query', 'args': {'cmd': tripleohelper.facts.command(['packages'])}, 'res': (
+        '{"packages": {"cloud-init": "0:0.7.6-2.el7.x86_64", '
+        '"NetworkManager": "1:1.0.6-27.el7.x86_64"}}', 0)},
+]
+
+expectation_install_base_packages = expectation_package_index + [
     {'func': 'run', 'args': {
         'cmd': 'yum install -y --quiet yum-utils iptables libselinux-python psmisc redhat-lsb-core rsync libguestfs-tools'}}]
 
@@ -70,6 +85,7 @@ expectation_clean_system = [
     {'func': 'run', 'args': {'cmd': 'systemctl disable NetworkManager'}},
     {'func': 'run', 'args': {'cmd': 'systemctl stop NetworkManager'}},
     {'func': 'run', 'args': {'cmd': 'pkill -9 dhclient'}},
+] + expectation_package_index + [
     {'func': 'run', 'args': {'cmd': 'yum remove -y --quiet cloud-init NetworkManager'}},
     {'func': 'run', 'args': {'cmd': 'systemctl enable network'}},
     {'func': 'run', 'args': {'cmd': 'systemctl restart network'}},
@@ -97,8 +113,9 @@ expectation_yum_update_with_reboot = []
 expectation_yum_update_with_reboot += expectation_yum_update
 expectation_yum_update_with_reboot += [
     {'func': 'run', 'args': {'cmd': 'grubby --set-default $(ls /boot/vmlinuz-*.x86_64|tail -1)'}},
-    {'func': 'run', 'args': {'cmd': 'grubby --default-kernel'}},
-    {'func': 'run', 'args': {'cmd': 'uname -r'}},
+    {'func': 'query', 'args': {'cmd': tripleohelper.facts.command(['kernel'])}, 'res': (
+        '{"kernel": {"release": "3.10.0-327.el7.x86_64", '
+        '"default": "/boot/vmlinuz-3.10.0-327.el7.x86_64"}}', 0)},
 ]
 
 
@@ -107,7 +124,21 @@ def test_yum_update_with_reboot(server):
     server.yum_update(allow_reboot=True)
 
 
-expectation_install_osp = [
+expectation_reboot = [
+    {'func': 'run', 'args': {'cmd': 'cat /proc/sys/kernel/random/boot_id'}, 'res': ('before', 0)},
+    {'func': 'run', 'args': {'cmd': 'reboot'}},
+    # the host has not gone down yet
+    {'func': 'run', 'args': {'cmd': 'cat /proc/sys/kernel/random/boot_id'}, 'res': ('before', 0)},
+    {'func': 'run', 'args': {'cmd': 'cat /proc/sys/kernel/random/boot_id'}, 'res': ('after', 0)},
+]
+
+
+@pytest.mark.parametrize('fake_sshclient', [expectation_reboot], indirect=['fake_sshclient'])
+def test_reboot(server):
+    server.reboot()
+
+
+expectation_install_osp = expectation_package_index + [
     {'func': 'run', 'args': {'cmd': 'yum install -y --quiet python-tripleoclient python-rdomanager-oscplugin'}},
 ]
 
@@ -117,6 +148,60 @@ def test_install_osp(server):
     server.install_osp()
 
 
+expectation_yum_transaction = expectation_package_index + [
+    {'func': 'run', 'args': {'cmd': (
+        "yum install -y --quiet tmux && yum remove -y --quiet NetworkManager")}},
+]
+
+
+@pytest.mark.parametrize('fake_sshclient', [expectation_yum_transaction], indirect=['fake_sshclient'])
+def test_yum_transaction(server):
+    with server.yum_transaction():
+        server.yum_install(['tmux', 'NetworkManager'])
+        server.yum_remove(['NetworkManager', 'bind'])
+    # already installed, nothing to do
+    server.yum_install(['tmux'])
+    server.yum_remove(['NetworkManager'])
+    # the index is updated, not gathered again
+    assert server.facts('packages')['packages'] == {
+        'cloud-init': '0:0.7.6-2.el7.x86_64', 'tmux': None}
+
+
+def test_yum_transaction_command():
+    transaction = tripleohelper.server.YumTransaction()
+    transaction.add(install=['tmux', '/usr/bin/virt-install'],
+                    remove=['NetworkManager'])
+    # a merged run fails or succeeds like the separate yum runs, a name
+    # yum skips or finds already provided is not an error
+    assert transaction.command({'NetworkManager': '1:1.0.6-27.el7.x86_64'}) == (
+        'yum install -y --quiet tmux /usr/bin/virt-install && '
+        'yum remove -y --quiet NetworkManager')
+    assert transaction.command({'tmux': '0:1.8-4.el7.x86_64'}) == (
+        'yum install -y --quiet /usr/bin/virt-install')
+
+
+expectation_yum_transaction_ignore_error = expectation_package_index + [
+    {'func': 'run', 'args': {'cmd': 'yum install -y --quiet tmux'}},
+    # run on its own, the failure is ignored
+    {'func': 'run', 'args': {'cmd': 'yum install -y --quiet bind'}, 'res': ('No package bind available.', 1)},
+    # the failure leaves the index unknown
+    {'func': 'query', 'args': {'cmd': tripleohelper.facts.command(['packages'])}, 'res': (
+        '{"packages": {"NetworkManager": "1:1.0.6-27.el7.x86_64", '
+        '"tmux": "0:1.8-4.el7.x86_64"}}', 0)},
+    {'func': 'run', 'args': {'cmd': 'yum remove -y --quiet NetworkManager'}, 'res': ('Error', 1)},
+]
+
+
+@pytest.mark.parametrize('fake_sshclient', [expectation_yum_transaction_ignore_error], indirect=['fake_sshclient'])
+def test_yum_transaction_ignore_error(server):
+    # the ignored failure does not hide the failure of the other packages
+    with pytest.raises(ssh_exception.SSHException):
+        with server.yum_transaction():
+            server.yum_install(['tmux'])
+            server.yum_install(['bind'], ignore_error=True)
+            server.yum_remove(['NetworkManager'])
+
+
 expectation_enable_user_needed_rhel = [
     # First case, we need to adjust root's authorized_keys file
     {'func': 'run', 'args': {'cmd': 'uname -a'}, 'res': ('Please login as the user "cloud-user"', 0)},
@@ -141,10 +226,75 @@ def test_enable_user(server_without_root_enabled):
     server_without_root_enabled.enable_user('root')
 
 expectation_fetch_image = [
-    {'func': 'run', 'args': {'cmd': 'test -f somewhere || curl -L -s -o somewhere http://host/image'}},
+    {'func': 'run', 'args': {'cmd': tripleohelper.image_cache.command('http://host/image', 'somewhere')}},
 ]
 
 
 @pytest.mark.parametrize('fake_sshclient', [expectation_fetch_image], indirect=['fake_sshclient'])
 def test_fetch_image(server):
     server.fetch_image('http://host/image', 'somewhere')
+
+
+def test_server_group(sshd, private_key, tmpdir):
+    servers = []
+    for i in range(4):
+        s = tripleohelper.server.Server(hostname='node%d' % i)
+        client = tripleohelper.ssh.SshClient(
+            hostname='127.0.0.1', user='root', key_filename=private_key,
+            port=sshd.port)
+        client.start()
+        s.ssh_pool.add_ssh_client('root', client)
+        servers.append(s)
+    group = tripleohelper.server.ServerGroup(servers, max_workers=2)
+
+    result = group.create_file('group', 'content')
+    assert list(result.results) == ['node0', 'node1', 'node2', 'node3']
+    assert tmpdir.join('group').read() == 'content'
+
+    result = group.run('sleep .2; test "$(cat group)" = content && echo ok')
+    assert result
+    assert list(result.results.values()) == [('ok', 0)] * 4
+
+    servers[2].ssh_pool._ssh_clients['root'].stop()
+    result = group.run('true')
+    assert list(result.errors) == ['node2']
+    assert list(result.results) == ['node0', 'node1', 'node3']
+    with pytest.raises(ssh_exception.SSHException):
+        result.raise_on_error()
+    for s in servers:
+        s.ssh_pool.stop_all()
+
+
+def test_server_group_hostnames():
+    servers = [tripleohelper.server.Server(hostname=h)
+               for h in ('node0', 'node1', 'node0')]
+    calls = []
+    with pytest.raises(ValueError):
+        tripleohelper.server.ServerGroup(servers).map(calls.append)
+    servers[2].hostname = None
+    with pytest.raises(ValueError):
+        tripleohelper.server.ServerGroup(servers).map(calls.append)
+    assert calls == []
+
+
+def test_facts(sshd, private_key):
+    s = tripleohelper.server.Server(hostname='node0')
+    client = tripleohelper.ssh.SshClient(
+        hostname='127.0.0.1', user='root', key_filename=private_key,
+        port=sshd.port)
+    client.start()
+    s.ssh_pool.add_ssh_client('root', client)
+
+    facts = s.facts('hostname', 'memory')
+    assert facts['hostname']['name'] == socket.gethostname()
+    assert facts['memory']['total'] > 0
+    commands = len(sshd.commands)
+    # the facts are cached
+    assert s.facts('memory') == {'memory': facts['memory']}
+    assert len(sshd.commands) == commands
+    s.invalidate_facts('memory')
+    assert set(s.facts('hostname', 'memory', 'nics')) == set(
+        ['hostname', 'memory', 'nics'])
+    assert len(sshd.commands) == commands + 1
+    assert sshd.commands[-1].endswith(' memory nics')
+    s.ssh_pool.stop_all()
@@ -0,0 +1,500 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from cryptography.hazmat.primitives.asymmetric import ed25519
+from cryptography.hazmat.primitives import serialization
+import paramiko
+from paramiko import ssh_exception
+import pytest
+
+import gzip
+import os
+import socket
+import time
+
+import tripleohelper.ssh
+import tripleohelper.stats
+
+
+def test_run(ssh_client):
+    assert ssh_client.run('echo foo; echo bar') == ('foo\nbar', 0)
+    assert ssh_client.run('exit 3', success_status=(3,)) == ('', 3)
+    with pytest.raises(ssh_exception.SSHException):
+        ssh_client.run('exit 1')
+
+
+def test_run_stats(ssh_client, monkeypatch):
+    stats = tripleohelper.stats.Stats()
+    monkeypatch.setattr(tripleohelper.stats, 'STATS', stats)
+    ssh_client.run('echo secret', custom_log='echo ***')
+    ssh_client.create_file('file', 'content')
+    assert [(r.kind, r.host, r.user, r.label, r.size) for r in stats.records] == [
+        ('run', '127.0.0.1', 'stack', 'echo ***', 6),
+        ('create_file', '127.0.0.1', 'stack', 'file', 7)]
+
+
+def test_run_latency(ssh_client):
+    sock = ssh_client._transport.sock
+    assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+    start = time.time()
+    for _ in range(10):
+        ssh_client.run('true')
+    # about 90ms per command when the packets wait for the delayed ACKs
+    assert time.time() - start < 0.5
+
+
+def test_run_large_output(ssh_client):
+    output, _ = ssh_client.run('seq 1 200000')
+    assert output.split('\n') == [str(i) for i in range(1, 200001)]
+
+
+def test_run_background_child(ssh_client):
+    # the child keeps the output open after the exit of the command
+    start = time.time()
+    output, _ = ssh_client.run('echo foo; sleep 5 &')
+    assert output == 'foo'
+    assert time.time() - start < 4
+
+
+def test_run_capture(ssh_client, tmpdir):
+    policy = tripleohelper.ssh.CapturePolicy(
+        head_size=10, tail_size=20, spill_dir=str(tmpdir.mkdir('spill')))
+    output, _ = ssh_client.run('seq 1 100000', capture=policy)
+    assert output.truncated
+    assert output.startswith('1\n2\n3\n4\n5\n\n[... ')
+    assert output.endswith('\n99998\n99999\n100000')
+    with gzip.open(output.spill_path) as f:
+        assert f.read().decode().split() == [str(i) for i in range(1, 100001)]
+
+    output, _ = ssh_client.run('echo foo', capture=policy)
+    assert output == 'foo'
+    assert not output.truncated
+    assert output.spill_path is None
+    assert len(tmpdir.join('spill').listdir()) == 1
+
+
+def test_stream(ssh_client):
+    # the "é" is split in two writes
+    stream = ssh_client.stream(
+        r"printf 'first\r\nsec'; sleep .1; printf 'ond\n\303'; sleep .1; printf '\251\nlast'")
+    assert list(stream) == ['first', 'second', u'\xe9', 'last']
+    assert stream.exit_status == 0
+
+
+def test_stream_max_line_length(ssh_client):
+    stream = ssh_client.stream('printf aaaaaaaaaa; printf "bbbbb\\n"')
+    stream._max_line_length = 4
+    lines = list(stream)
+    assert ''.join(lines) == 'a' * 10 + 'b' * 5
+    assert all(len(line) <= 4 for line in lines)
+
+
+def test_stream_failure(ssh_client):
+    stream = ssh_client.stream('echo oops; exit 2')
+    with pytest.raises(ssh_exception.SSHException):
+        list(stream)
+    assert stream.exit_status == 2
+
+
+def test_sftp_session_reused(ssh_client, sshd, tmpdir):
+    for i in range(3):
+        ssh_client.create_file('file%d' % i, 'content %d' % i)
+    with ssh_client.open('file2') as f:
+        assert f.read() == b'content 2'
+    assert tmpdir.join('file0').read() == 'content 0'
+    assert ssh_client.sftp_session_count == 1
+    assert sshd.sftp_sessions == 1
+
+    # a new session is opened after a reconnection
+    ssh_client.stop()
+    ssh_client.start()
+    ssh_client.create_file('file3', 'content 3')
+    assert ssh_client.sftp_session_count == 2
+
+
+def test_send_file_parallel(ssh_client, sshd, tmpdir, monkeypatch):
+    monkeypatch.setattr(ssh_client, 'upload_block_size', 1000)
+    content = os.urandom(10 * 1000 + 7)
+    tmpdir.join('local').write_binary(content)
+    ssh_client.send_file(str(tmpdir.join('local')), 'remote', parallel=4)
+    assert tmpdir.join('remote').read_binary() == content
+    # the main session, plus one per range
+    assert sshd.sftp_sessions == 5
+    assert ssh_client.sftp_session_count == 5
+
+    # the checksum is verified
+    monkeypatch.setattr(ssh_client, '_remote_sha256', lambda path: 'wrong')
+    with pytest.raises(ssh_exception.SSHException):
+        ssh_client.send_file(str(tmpdir.join('local')), 'remote', parallel=4)
+
+
+def test_get_files(ssh_client, tmpdir):
+    content = os.urandom(3 * 1048576 + 10)
+    tmpdir.join('big').write_binary(content)
+    tmpdir.join('small').write('small')
+    chunks = list(ssh_client.iter_file('big'))
+    assert [len(c) for c in chunks] == [1048576] * 3 + [10]
+    assert b''.join(chunks) == content
+
+    local = tmpdir.mkdir('local')
+    sessions = ssh_client.sftp_session_count
+    assert ssh_client.get_files([
+        ('big', str(local.join('big'))),
+        ('small', str(local.join('small')))]) == [len(content), 5]
+    # one session per worker
+    assert ssh_client.sftp_session_count == sessions + 2
+    assert local.join('big').read_binary() == content
+    assert local.join('small').read() == 'small'
+
+    with pytest.raises(IOError):
+        ssh_client.get_file('missing', str(local.join('missing')))
+    assert sorted(local.listdir()) == [local.join('big'), local.join('small')]
+
+
+@pytest.mark.parametrize('use_tar,compression', [
+    (False, None), (True, None), (True, 'gz'), (True, 'bz2')])
+def test_send_dir(ssh_client, tmpdir, use_tar, compression):
+    src = tmpdir.mkdir('src').mkdir('templates')
+    src.join('a.yaml').write('a')
+    src.mkdir('sub').join('b.yaml').write('b')
+    tmpdir.mkdir('dest')
+    cwd = os.getcwd()
+
+    ssh_client.send_dir(str(src), str(tmpdir.join('dest')),
+                        use_tar=use_tar, compression=compression)
+    assert os.getcwd() == cwd
+    assert tmpdir.join('dest', 'templates', 'a.yaml').read() == 'a'
+    assert tmpdir.join('dest', 'templates', 'sub', 'b.yaml').read() == 'b'
+
+
+@pytest.mark.skipif(os.getuid() != 0, reason='chown needs root')
+def test_send_dir_owner(ssh_client, tmpdir):
+    src = tmpdir.mkdir('src').mkdir('templates')
+    src.join('a.yaml').write('a')
+    os.chown(str(src.join('a.yaml')), 1234, 1234)
+
+    ssh_client.send_dir(str(src), str(tmpdir.mkdir('dest')), use_tar=True)
+    stat = tmpdir.join('dest', 'templates', 'a.yaml').stat()
+    assert (stat.uid, stat.gid) == (os.getuid(), os.getgid())
+
+
+def test_send_dir_delta(ssh_client, sshd, tmpdir):
+    src = tmpdir.mkdir('src').mkdir('templates')
+    src.join('a.yaml').write('a')
+    src.join('b.yaml').write('b')
+    dest = tmpdir.mkdir('dest').mkdir('templates')
+    dest.join('a.yaml').write('a')
+    dest.join('b.yaml').write('old b')
+    dest.join('c.yaml').write('c')
+
+    sent, deleted = ssh_client.send_dir(
+        str(src), str(tmpdir.join('dest')), delta=True, delete=True)
+    assert sent == ['b.yaml']
+    assert deleted == ['c.yaml']
+    assert dest.join('b.yaml').read() == 'b'
+    assert not dest.join('c.yaml').exists()
+
+    assert ssh_client.send_dir(
+        str(src), str(tmpdir.join('dest')), delta=True) == ([], [])
+
+
+def test_send_file_delta(ssh_client, tmpdir):
+    tmpdir.join('local').write('content')
+    ssh_client.send_file(str(tmpdir.join('local')), 'remote', delta=True)
+    assert tmpdir.join('remote').read() == 'content'
+    tmpdir.join('remote').setmtime(0)
+    ssh_client.send_file(str(tmpdir.join('local')), 'remote', delta=True)
+    assert tmpdir.join('remote').mtime() == 0
+
+
+def test_shared_bastion(sshd, private_key):
+    clients = [
+        tripleohelper.ssh.SshClient(
+            hostname='127.0.0.1', user='stack', key_filename=private_key,
+            via_ip='127.0.0.1', port=sshd.port)
+        for _ in range(3)]
+    for client in clients:
+        client.start()
+        assert client.run('echo foo') == ('foo', 0)
+    # one bastion connection plus one connection per client
+    assert sshd.connections == 4
+    bastion = ('127.0.0.1', sshd.port, 'stack', private_key)
+    assert tripleohelper.ssh.BASTIONS.refcount(bastion) == 3
+
+    # the bastion connection is reopened if it dies
+    tripleohelper.ssh.BASTIONS.get_transport(bastion).close()
+    clients[0].stop()
+    clients[0].start()
+    assert clients[0].run('echo foo') == ('foo', 0)
+
+    for client in clients:
+        client.stop()
+    assert tripleohelper.ssh.BASTIONS.refcount(bastion) == 0
+
+
+def test_bastion_released_on_failure(sshd, private_key, monkeypatch):
+    def fail(self):
+        raise ssh_exception.SSHException('host unreachable')
+    monkeypatch.setattr(tripleohelper.ssh.SshClient,
+                        '_get_transport_via_ip', fail)
+    client = tripleohelper.ssh.SshClient(
+        hostname='127.0.0.1', user='stack', key_filename=private_key,
+        via_ip='127.0.0.1', port=sshd.port)
+    with pytest.raises(ssh_exception.SSHException):
+        client.start(timeout=0)
+    bastion = ('127.0.0.1', sshd.port, 'stack', private_key)
+    assert tripleohelper.ssh.BASTIONS.refcount(bastion) == 0
+    assert client._bastion is None
+
+
+def test_shell_session(ssh_client, sshd, tmpdir):
+    tmpdir.join('rc').write('export FOO=bar; echo sourced >> sourced.log\n')
+    ssh_client.add_environment_file('rc')
+    ssh_client.enable_shell_session()
+    assert ssh_client.run('echo $FOO') == ('bar', 0)
+    assert ssh_client.run('cd /; printf foo; exit 4',
+                          success_status=(4,)) == ('foo', 4)
+    # the cd of the previous command has not leaked
+    assert ssh_client.run('pwd') == (str(tmpdir), 0)
+    with pytest.raises(ssh_exception.SSHException):
+        ssh_client.run('false')
+    assert len(sshd.commands) == 1
+    assert tmpdir.join('sourced.log').read() == 'sourced\n'
+
+    ssh_client.enable_shell_session(False)
+    assert ssh_client.run('echo $FOO') == ('bar', 0)
+    assert len(sshd.commands) == 2
+
+
+def test_shell_session_capture(ssh_client, sshd, tmpdir):
+    ssh_client.enable_shell_session()
+    ssh_client.run('true')
+    policy = tripleohelper.ssh.CapturePolicy(
+        head_size=10, tail_size=20, spill_dir=str(tmpdir.mkdir('spill')))
+    output, _ = ssh_client.run('seq 1 100000', capture=policy)
+    assert output.truncated
+    # the captured command has its own channel
+    assert sshd.commands[-1].endswith('seq 1 100000')
+    assert len(sshd.commands) == 2
+
+
+def test_shell_session_precedence(ssh_client, tmpdir):
+    tmpdir.join('stackrc').write('export OS_AUTH_URL=undercloud\n')
+    tmpdir.join('overcloudrc').write('export OS_AUTH_URL=overcloud\n')
+    ssh_client.add_environment_file('stackrc')
+    expected = ssh_client.run('echo $OS_AUTH_URL')
+    ssh_client.enable_shell_session()
+    assert ssh_client.run('echo $OS_AUTH_URL') == expected == (
+        'undercloud', 0)
+    # a file added to an open session does not override the first one
+    ssh_client.add_environment_file('overcloudrc')
+    assert ssh_client.run('echo $OS_AUTH_URL') == ('undercloud', 0)
+    ssh_client.enable_shell_session(False)
+    assert ssh_client.run('echo $OS_AUTH_URL') == ('undercloud', 0)
+    # same for a new session that sources both files
+    ssh_client.enable_shell_session()
+    assert ssh_client.run('echo $OS_AUTH_URL') == ('undercloud', 0)
+
+
+def test_reconnect(ssh_client, sshd):
+    ssh_client._transport.close()
+    assert not ssh_client.is_alive()
+    assert ssh_client.run('echo foo') == ('foo', 0)
+    assert ssh_client.is_alive()
+    assert sshd.connections == 2
+
+
+def test_probe(ssh_client, sshd, monkeypatch):
+    pool = tripleohelper.ssh.PoolSshClient()
+    pool.add_ssh_client('stack', ssh_client)
+    assert pool.health() == {'stack': True}
+
+    # a peer that stopped answering, the transport is still active
+    monkeypatch.setattr(ssh_client._transport, 'global_request',
+                        lambda *args, **kwargs: time.sleep(1))
+    assert not ssh_client.probe(timeout=.2)
+    assert not ssh_client.is_alive()
+    assert ssh_client.run('echo foo') == ('foo', 0)
+    assert sshd.connections == 2
+
+    # an operation probes an idle connection
+    monkeypatch.setattr(ssh_client._transport, 'global_request',
+                        lambda *args, **kwargs: time.sleep(1))
+    monkeypatch.setattr(tripleohelper.ssh, 'DEFAULT_PROBE_TIMEOUT', .2)
+    monkeypatch.setattr(ssh_client, '_last_probe', 0)
+    assert ssh_client.run('echo foo') == ('foo', 0)
+    assert sshd.connections == 3
+
+
+def test_run_many(ssh_client, sshd, tmpdir):
+    results = ssh_client.run_many([
+        'echo foo',
+        {'cmd': 'exit 3', 'success_status': (0, 3)},
+        {'cmd': 'false', 'ignore_error': True},
+        'printf bar; sleep .2'])
+    assert len(sshd.commands) == 1
+    assert [(r.output, r.exit_status) for r in results] == [
+        ('foo', 0), ('', 3), ('', 1), ('bar', 0)]
+    assert results[3].duration >= .2
+
+    with pytest.raises(ssh_exception.SSHException) as excinfo:
+        ssh_client.run_many(['true', 'exit 2', 'touch not_run'])
+    assert 'exit 2' in str(excinfo.value)
+    assert not tmpdir.join('not_run').exists()
+
+
+def test_run_async(ssh_client):
+    pool = tripleohelper.ssh.PoolSshClient(max_sessions=4)
+    pool.add_ssh_client('stack', ssh_client)
+    start = time.time()
+    futures = [pool.run_async('stack', 'sleep 1; echo %d' % i)
+               for i in range(4)]
+    futures.append(pool.run_async('stack', 'exit 1'))
+    results = tripleohelper.ssh.gather(futures, return_exceptions=True)
+    assert time.time() - start < 3
+    assert results[:4] == [(str(i), 0) for i in range(4)]
+    assert isinstance(results[4], ssh_exception.SSHException)
+    with pytest.raises(ssh_exception.SSHException):
+        tripleohelper.ssh.gather(futures)
+    pool.stop_all()
+
+
+def test_environment_snapshot(ssh_client, sshd, tmpdir):
+    tmpdir.join('rc').write(
+        "export FOO=\"it's foo\"; echo sourced >> sourced.log\n")
+    ssh_client.add_environment_file('rc')
+    ssh_client.enable_environment_snapshot()
+    assert ssh_client.run('echo $FOO') == ("it's foo", 0)
+    assert [r.output for r in ssh_client.run_many(['echo $FOO'])] == ["it's foo"]
+    assert list(ssh_client.stream('echo $FOO')) == ["it's foo"]
+    assert tmpdir.join('sourced.log').read() == 'sourced\n'
+    assert len([c for c in sshd.commands if '. rc' in c]) == 1
+    # the password of the rc files is not on the command lines
+    assert not [c for c in sshd.commands if 'foo' in c]
+    snapshots = tmpdir.listdir(lambda f: f.basename.startswith(
+        '.tripleohelper-environment-'))
+    assert len(snapshots) == 1
+    assert snapshots[0].stat().mode & 0o777 == 0o600
+
+    # a new file invalidates the snapshot
+    tmpdir.join('rc2').write('export BAR=bar\n')
+    ssh_client.add_environment_file('rc2')
+    assert ssh_client.run('echo $FOO $BAR') == ("it's foo bar", 0)
+    assert tmpdir.join('sourced.log').read() == 'sourced\n' * 2
+
+    # the files are sourced before the command if the capture fails
+    ssh_client.add_environment_file('missing')
+    ssh_client.run('echo $FOO', ignore_error=True)
+    assert sshd.commands[-1].startswith('. missing; . rc2; . rc;')
+
+
+def test_environment_snapshot_output(ssh_client, tmpdir):
+    tmpdir.join('rc').write('echo Undercloud ready.\nexport FOO=bar\n')
+    ssh_client.add_environment_file('rc')
+    ssh_client.enable_environment_snapshot()
+    assert ssh_client.run('echo $FOO') == ('bar', 0)
+    assert ssh_client._get_environment() == {'FOO': 'bar'}
+
+
+def test_private_key_cache(sshd, private_key, tmpdir):
+    cache = tripleohelper.ssh.PrivateKeyCache()
+    key = cache.load(private_key)
+    assert isinstance(key, paramiko.RSAKey)
+    assert cache.load(private_key) is key
+    assert cache.load(None) is None
+
+    # the key is parsed again if the file changes
+    path = tmpdir.join('id_ed25519')
+    path.write_binary(ed25519.Ed25519PrivateKey.generate().private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.OpenSSH,
+        serialization.NoEncryption()))
+    path.setmtime(1000)
+    key = cache.load(str(path))
+    assert isinstance(key, paramiko.Ed25519Key)
+    path.setmtime(2000)
+    assert cache.load(str(path)) is not key
+
+    client = tripleohelper.ssh.SshClient(
+        hostname='127.0.0.1', user='stack', key_filename=str(path),
+        port=sshd.port)
+    client.start()
+    assert client.run('echo foo') == ('foo', 0)
+    client.stop()
+
+
+def test_start_deadline(monkeypatch):
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    client = tripleohelper.ssh.SshClient(
+        hostname='127.0.0.1', user='stack', port=port)
+    start = time.time()
+    with pytest.raises(socket.error):
+        client.start(timeout=1)
+    assert time.time() - start < 2
+
+
+def test_wait_for_reboot(ssh_client, monkeypatch):
+    monkeypatch.setattr(ssh_client, 'read_boot_id', lambda: 'after')
+    start = ssh_client.start
+    # paramiko issue 615
+    failures = [TypeError("'NoneType' object is not iterable")]
+
+    def flaky_start(timeout=None):
+        if failures:
+            raise failures.pop(0)
+        start(timeout=timeout)
+    monkeypatch.setattr(ssh_client, 'start', flaky_start)
+    ssh_client.wait_for_reboot('before', timeout=10)
+    assert failures == []
+    assert ssh_client.run('echo foo') == ('foo', 0)
+
+
+def test_wait_for_reboot_hung_host(ssh_client, monkeypatch):
+    # the host hangs while it shuts down, the command never returns
+    monkeypatch.setattr(ssh_client, 'read_boot_id',
+                        lambda: ssh_client.run('sleep 30')[0])
+    start = time.time()
+    with pytest.raises(ssh_exception.SSHException):
+        ssh_client.wait_for_reboot('before', timeout=1)
+    assert time.time() - start < 3
+
+
+def test_backoff(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(time, 'sleep', sleeps.append)
+    attempts = list(tripleohelper.ssh.backoff(0))
+    assert attempts == [0]
+    for attempt in tripleohelper.ssh.backoff(3600, initial_delay=1, max_delay=4):
+        if attempt == 5:
+            break
+    assert len(sleeps) == 5
+    assert [.5 <= s / m <= 1 for s, m in zip(sleeps, [1, 2, 4, 4, 4])] == [True] * 5
+
+
+def test_query(ssh_client):
+    stdout, stderr, exit_status = ssh_client.query(
+        "printf '\\033[1mout\\n'; printf 'err\\n' >&2; exit 3",
+        success_status=(3,))
+    assert (stdout, stderr, exit_status) == (b'\x1b[1mout\n', b'err\n', 3)
+    # a large standard error does not block the standard output
+    stdout, stderr, _ = ssh_client.query(
+        'head -c 4194304 /dev/zero >&2; echo done')
+    assert stdout == b'done\n'
+    assert len(stderr) == 4194304
+    with pytest.raises(ssh_exception.SSHException):
+        ssh_client.query('false')
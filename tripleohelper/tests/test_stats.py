@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+
+import pytest
+
+import tripleohelper.stats
+
+
+def test_histogram():
+    h = tripleohelper.stats.histogram([float(i) for i in range(1, 101)])
+    assert (h['count'], h['min'], h['max'], h['mean']) == (100, 1, 100, 50.5)
+    assert (h['p50'], h['p90'], h['p99']) == (51, 91, 100)
+    assert list(h['buckets'].values()) == [0, 0, 1, 9, 50, 40, 0]
+
+
+def test_summary(tmpdir):
+    stats = tripleohelper.stats.Stats()
+    stats.record('run', 'host1', 'root', 'uname -a', 1, size=10)
+    stats.record('run', 'host2', 'root', 'uname -a', 3, size=10)
+    with pytest.raises(ValueError):
+        with stats.measure('send_file', 'host1', 'root', '/etc/hosts') as m:
+            m['size'] = 42
+            raise ValueError()
+    summary = stats.summary()
+    assert summary['commands']['run uname -a']['mean'] == 2
+    assert summary['commands']['run uname -a']['bytes'] == 20
+    assert summary['commands']['send_file /etc/hosts']['bytes'] == 42
+    assert summary['hosts']['host1']['count'] == 2
+
+    stats.dump(str(tmpdir.join('stats.json')))
+    assert json.loads(tmpdir.join('stats.json').read()) == json.loads(
+        json.dumps(summary))
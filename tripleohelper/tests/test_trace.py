@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import threading
+
+import pytest
+
+import tripleohelper.trace
+
+
+@pytest.fixture
+def tracer(monkeypatch):
+    tracer = tripleohelper.trace.Tracer()
+    tracer.enable()
+    monkeypatch.setattr(tripleohelper.trace, 'TRACER', tracer)
+    return tracer
+
+
+def test_span(tmpdir, tracer):
+    tracer.begin('step undercloud', 'cli')
+    with tracer.span('run uname -a', 'ssh', host='host1'):
+        pass
+    with pytest.raises(ValueError):
+        with tracer.span('send_file /etc/hosts', 'ssh'):
+            raise ValueError()
+
+    def deploy():
+        with tracer.span('deploy', 'ovb'):
+            pass
+    thread = threading.Thread(target=deploy, name='worker')
+    thread.start()
+    thread.join()
+
+    tracer.dump(str(tmpdir.join('trace.json')))
+    events = json.load(tmpdir.join('trace.json').open())['traceEvents']
+    spans = [(e['ph'], e['name']) for e in events if e['ph'] != 'M']
+    assert spans == [('B', 'step undercloud'), ('X', 'run uname -a'),
+                     ('X', 'send_file /etc/hosts'), ('X', 'deploy'),
+                     ('E', 'step undercloud')]
+    assert [e['args'] for e in events if e['ph'] == 'X'][0] == {
+        'host': 'host1'}
+    tracks = dict((e['tid'], e['args']['name'])
+                  for e in events if e['ph'] == 'M')
+    assert len(tracks) == 2
+    assert 'worker' in tracks.values()
+
+
+def test_disabled():
+    tracer = tripleohelper.trace.Tracer()
+    with tracer.span('run uname -a', 'ssh'):
+        tracer.begin('step undercloud', 'cli')
+    assert tracer.events == []
+
+
+def test_traced_methods(tracer):
+    @tripleohelper.trace.traced_methods
+    class Node(object):
+        def deploy(self, name):
+            return name
+
+        def _private(self):
+            pass
+
+    node = Node()
+    assert node.deploy('bm0') == 'bm0'
+    node._private()
+    assert [e['name'] for e in tracer.events if e['ph'] == 'X'] == [
+        'Node.deploy']
+
+
+def test_traced_proxy(tracer):
+    class Servers(object):
+        def list(self):
+            return ['undercloud']
+
+    class Nova(object):
+        version = '2.1'
+        servers = Servers()
+
+    nova_api = tripleohelper.trace.TracedProxy(Nova(), 'nova')
+    assert nova_api.servers.list() == ['undercloud']
+    assert nova_api.version == '2.1'
+    events = [e for e in tracer.events if e['ph'] == 'X']
+    assert [(e['name'], e['cat']) for e in events] == [
+        ('nova.servers.list', 'nova')]
@@ -16,15 +16,19 @@
 
 import pytest
 
+import tripleohelper.facts
+import tripleohelper.image_cache
 import tripleohelper.tests.test_server
 import tripleohelper.undercloud
 
 files = {
     'overcloud-full': {
         'image_path': 'http://192.168.1.2/mburns/8.0/2015-12-03.1/images/overcloud-full.tar',
+        'digest': 'sha256:5891b5b522d5df086d0ff0b110fbd9d21bb4fc7163af34d08286a2e846f6be03',
     },
     'deploy-ramdisk-ironic': {
         'image_path': 'http://192.168.1.2/mburns/latest-8.0-images/deploy-ramdisk-ironic.tar',
+        'keep_tarball': True,
     }
 }
 
@@ -43,9 +47,9 @@ def test_set_selinux(undercloud):
 
 
 expectation_fix_hostname = [
-    {'func': 'run', 'args': {'cmd': 'hostname'}, 'res': ('hostname.localdomain\n', 0)},
-    {'func': 'run', 'args': {'cmd': 'hostname -s'}, 'res': ('hostname\n', 0)},
-    {'func': 'run', 'args': {'cmd': 'cat /etc/hostname'}, 'res': ('a.b\n', 0,)},
+    {'func': 'query', 'args': {'cmd': tripleohelper.facts.command(['hostname'])}, 'res': (
+        '{"hostname": {"name": "hostname.localdomain", "short": "hostname", '
+        '"file": "a.b"}}', 0)},
     {'func': 'run', 'args': {'cmd': "sed -i 's,127.0.0.1,127.0.0.1 hostname a.b hostname.localdomain undercloud.openstacklocal,' /etc/hosts"}},
 ]
 
@@ -67,10 +71,8 @@ def test_set_ctlplane_mtu(undercloud):
 
 
 expectation_openstack_undercloud_install = [
-    {'func': 'run', 'args': {'cmd': (
-        'repoquery --whatprovides /usr/share/instack-undercloud/'
-        'puppet-stack-config/puppet-stack-config.pp')
-    }, 'res': ('instack-undercloud-0:2.2.0-1.el7ost.noarch\n', 0,)},
+    {'func': 'query', 'args': {'cmd': tripleohelper.facts.command(['packages'])}, 'res': (
+        '{"packages": {"instack-undercloud": "0:2.2.0-1.el7ost.noarch"}}', 0)},
     {'func': 'run', 'args': {'cmd': (
         'sed -i "s/.*Keystone_domain\\[\'heat_domain\'\\].*/Service\\'
         '[\'keystone\'\\] -> Class\\[\'::keystone::roles::admin\'\\] '
@@ -78,7 +80,8 @@ expectation_openstack_undercloud_install = [
         '/usr/share/instack-undercloud/puppet-stack-config/'
         'puppet-stack-config.pp')}},
     {'func': 'run', 'args': {'cmd': 'OS_PASSWORD=bob openstack undercloud install'}},
-    {'func': 'run', 'args': {'cmd': 'rpm -qa openstack-ironic-api'}, 'res': ('openstack-ironic-api-4.2.2-3.el7ost.noarch\n', 0,)},
+    {'func': 'query', 'args': {'cmd': tripleohelper.facts.command(['packages'])}, 'res': (
+        '{"packages": {"openstack-ironic-api": "0:4.2.2-3.el7ost.noarch"}}', 0)},
     {'func': 'run', 'args': {'cmd': 'systemctl start openstack-ironic-api.service'}},
     {'func': 'run', 'args': {'cmd': '. stackrc; heat stack-list'}},
 ]
@@ -97,10 +100,23 @@ expectation_configure = [
                                      "--enable=rhel-7-server-extras-rpms")}}]
 
 expectation_configure += tripleohelper.tests.test_server.expectation_create_user
-expectation_configure += tripleohelper.tests.test_server.expectation_install_base_packages
-expectation_configure += tripleohelper.tests.test_server.expectation_clean_system
+expectation_configure += [
+    {'func': 'run', 'args': {'cmd': 'systemctl disable NetworkManager'}},
+    {'func': 'run', 'args': {'cmd': 'systemctl stop NetworkManager'}},
+    {'func': 'run', 'args': {'cmd': 'pkill -9 dhclient'}},
+]
+# the packages are installed and removed in a single transaction, before
+# the network restart
+expectation_configure += tripleohelper.tests.test_server.expectation_package_index
+expectation_configure += [
+    {'func': 'run', 'args': {'cmd': (
+        "yum install -y --quiet yum-utils iptables libselinux-python psmisc redhat-lsb-core rsync "
+        "libguestfs-tools && "
+        "yum remove -y --quiet cloud-init NetworkManager")}},
+    {'func': 'run', 'args': {'cmd': 'systemctl enable network'}},
+    {'func': 'run', 'args': {'cmd': 'systemctl restart network'}},
+]
 expectation_configure += tripleohelper.tests.test_server.expectation_yum_update_with_reboot
-expectation_configure += [{'func': 'run', 'args': {'cmd': 'uname -a'}}]
 expectation_configure += tripleohelper.tests.test_server.expectation_install_osp
 expectation_configure += expectation_set_selinux
 expectation_configure += expectation_fix_hostname
@@ -116,10 +132,14 @@ def test_configure(undercloud):
 
 
 expectation_fetch_overcloud_images = [
-    {'func': 'run', 'args': {'cmd': '. stackrc; test -f /home/stack/deploy-ramdisk-ironic.tar || curl -L -s -o /home/stack/deploy-ramdisk-ironic.tar http://192.168.1.2/mburns/latest-8.0-images/deploy-ramdisk-ironic.tar'}},
-    {'func': 'run', 'args': {'cmd': '. stackrc; tar xf /home/stack/deploy-ramdisk-ironic.tar'}},
-    {'func': 'run', 'args': {'cmd': '. stackrc; test -f /home/stack/overcloud-full.tar || curl -L -s -o /home/stack/overcloud-full.tar http://192.168.1.2/mburns/8.0/2015-12-03.1/images/overcloud-full.tar'}},
-    {'func': 'run', 'args': {'cmd': '. stackrc; tar xf /home/stack/overcloud-full.tar'}},
+    {'func': 'run', 'args': {'cmd': '. stackrc; ' + tripleohelper.image_cache.command(
+        'http://192.168.1.2/mburns/latest-8.0-images/deploy-ramdisk-ironic.tar',
+        '/home/stack/deploy-ramdisk-ironic.tar') + ' && tar xf /home/stack/deploy-ramdisk-ironic.tar'}},
+    {'func': 'run', 'args': {'cmd': '. stackrc; ' + tripleohelper.image_cache.extract_command(
+        'http://192.168.1.2/mburns/8.0/2015-12-03.1/images/overcloud-full.tar',
+        digest='sha256:5891b5b522d5df086d0ff0b110fbd9d21bb4fc7163af34d08286a2e846f6be03')},
+     'res': ('extracted sha256:5891b5b522d5df086d0ff0b110fbd9d21bb4fc7163af34d08286a2e846f6be03 '
+             '1073741824 8000', 0)},
 ]
 
 
@@ -145,7 +165,7 @@ expectation_load_instackenv = [
     {'func': 'run', 'args': {'cmd': '. stackrc; jq -M ".nodes|length" /home/stack/instackenv.json'}, 'res': ('0\n', 0)},
     {'func': 'run', 'args': {'cmd': '. stackrc; jq -M ".|length" /home/stack/instackenv.json'}, 'res': ('4\n', 0)},
     {'func': 'run', 'args': {'cmd': '. stackrc; ironic node-list|grep -c "power off"'}, 'res': ('4\n', 0)},
-    {'func': 'run', 'args': {'cmd': ". stackrc; ironic node-list --fields uuid|awk '/-.*-/ {print $2}'"}},
+    {'func': 'query', 'args': {'cmd': ". stackrc; ironic node-list --fields uuid|awk '/-.*-/ {print $2}'"}},
     {'func': 'run', 'args': {'cmd': '. stackrc; openstack baremetal configure boot'}},
 ]
 
@@ -155,7 +175,7 @@ def test_load_instackenv(undercloud):
     undercloud.load_instackenv()
 
 
-expectation_start_overcloud = [
+expectation_start_overcloud = tripleohelper.tests.test_server.expectation_package_index + [
     {'func': 'run', 'args': {'cmd': 'yum install -y --quiet ipmitool'}},
     {'func': 'run', 'args': {'cmd': 'ipmitool -I lanplus -H neverland -U root -P pw chassis power off'}},
     {'func': 'run', 'args': {'cmd': (
@@ -182,10 +202,12 @@ def test_start_overcloud_deploy(undercloud):
 
 
 expectation_nova_version = [
-    {'func': 'run', 'args': {'cmd': 'nova-manage --version'}, 'res': ('14.0.4\n', 0)},
+    {'func': 'query', 'args': {'cmd': 'nova-manage --version'}, 'res': ('14.0.4\n', 0)},
 ]
 
 
 @pytest.mark.parametrize('fake_sshclient', [expectation_nova_version], indirect=['fake_sshclient'])
 def test_nova_version(undercloud):
-    undercloud.nova_version()
+    assert undercloud.nova_version() == 14
+    # the version is cached
+    assert undercloud.nova_version() == 14
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Trace a run in the Chrome trace-event format.
+
+The spans can be loaded in chrome://tracing or in https://ui.perfetto.dev,
+each thread is a track. The tracer is disabled by default, the spans cost
+nothing until TRACER.enable() is called.
+"""
+
+import contextlib
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+
+
+class Tracer(object):
+    """Collect the spans of a run."""
+    def __init__(self):
+        self.enabled = False
+        self._events = []
+        self._threads = set()
+        self._open = []
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    def enable(self):
+        self.enabled = True
+
+    def _event(self, ph, name, cat, ts, **kwargs):
+        thread = threading.current_thread()
+        event = {'ph': ph, 'name': name, 'cat': cat, 'ts': ts,
+                 'pid': os.getpid(), 'tid': thread.ident}
+        event.update(kwargs)
+        with self._lock:
+            if thread.ident not in self._threads:
+                # name the track of the thread
+                self._threads.add(thread.ident)
+                self._events.append({
+                    'ph': 'M', 'name': 'thread_name', 'pid': os.getpid(),
+                    'tid': thread.ident, 'args': {'name': thread.name}})
+            self._events.append(event)
+        return event
+
+    def _now(self):
+        return int((time.time() - self._start) * 1000000)
+
+    @contextlib.contextmanager
+    def span(self, name, cat, **args):
+        """Record the duration of a block, even if it raises.
+
+        :param name: the name of the span
+        :param cat: the category, like 'ssh' or 'nova'
+        :param args: some extra details to show with the span
+        """
+        if not self.enabled:
+            yield
+            return
+        start = self._now()
+        try:
+            yield
+        finally:
+            self._event('X', name, cat, start, dur=self._now() - start,
+                        args=args)
+
+    def begin(self, name, cat):
+        """Open a span that ends with the next end() or with dump()."""
+        if self.enabled:
+            self._open.append(self._event('B', name, cat, self._now()))
+
+    def end(self):
+        if self.enabled and self._open:
+            event = self._open.pop()
+            self._event('E', event['name'], event['cat'], self._now())
+
+    @property
+    def events(self):
+        with self._lock:
+            return list(self._events)
+
+    def dump(self, path):
+        """Close the open spans and write the trace in a JSON file."""
+        while self._open:
+            self.end()
+        with open(path, 'w') as fd:
+            json.dump({'traceEvents': self.events,
+                       'displayTimeUnit': 'ms'}, fd)
+
+
+# The tracer of the process.
+TRACER = Tracer()
+
+
+def traced_methods(cls):
+    """Decorate a class to record a span per call of its public methods.
+
+    Only the methods defined by the class itself are traced, the spans
+    are named Class.method.
+    """
+    for name, value in list(vars(cls).items()):
+        if name.startswith('_') or not inspect.isfunction(value):
+            continue
+
+        def make_wrapper(func, span_name):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not TRACER.enabled:
+                    return func(*args, **kwargs)
+                with TRACER.span(span_name, cls.__module__):
+                    return func(*args, **kwargs)
+            return wrapper
+        setattr(cls, name, make_wrapper(value, '%s.%s' % (cls.__name__, name)))
+    return cls
+
+
+class TracedProxy(object):
+    """Record a span per call of the methods of an API client.
+
+        nova_api = TracedProxy(nova_api, 'nova')
+        nova_api.servers.list()  # recorded as nova.servers.list
+
+    The attributes that are not callable are wrapped as well, to trace the
+    managers of the clients.
+    """
+    def __init__(self, obj, name):
+        self._obj = obj
+        self._name = name
+
+    def __getattr__(self, attr):
+        value = getattr(self._obj, attr)
+        name = '%s.%s' % (self._name, attr)
+        if callable(value):
+            @functools.wraps(value)
+            def wrapper(*args, **kwargs):
+                with TRACER.span(name, self._name.split('.')[0]):
+                    return value(*args, **kwargs)
+            return wrapper
+        if isinstance(value, (str, bytes, int, float, bool, list, dict,
+                              tuple, type(None))):
+            return value
+        return TracedProxy(value, name)
@@ -18,11 +18,15 @@ import logging
 import time
 import yaml
 
+from tripleohelper import image_cache
+from tripleohelper import ssh
+from tripleohelper import trace
 from tripleohelper.server import Server
 
 LOG = logging.getLogger('tripleohelper')
 
 
+@trace.traced_methods
 class Undercloud(Server):
     def __init__(self, **kwargs):
         self.baremetal_factory = None
@@ -34,8 +38,9 @@ class Undercloud(Server):
         """
         self.enable_repositories(repositories)
         self.create_stack_user()
-        self.install_base_packages()
-        self.clean_system()
+        with self.yum_transaction():
+            self.install_base_packages()
+            self.clean_system()
         self.yum_update(allow_reboot=True)
         self.install_osp()
         self.set_selinux('permissive')
@@ -46,42 +51,74 @@ class Undercloud(Server):
             'find /etc/sysconfig/network-scripts '
             '-name "ifcfg-eth?" -exec sed -i \'$ iMTU="%d"\' {} \;') % mtu)
         self.run('systemctl restart network')
+        self.invalidate_facts('nics')
 
     def fix_hostname(self):
-        hostname = self.run('hostname')[0].rstrip('\n')
-        hostname_s = self.run('hostname -s')[0].rstrip('\n')
-        hostname_f = self.run('cat /etc/hostname')[0].rstrip('\n')
-        self.run("sed -i 's,127.0.0.1,127.0.0.1 %s %s %s undercloud.openstacklocal,' /etc/hosts" % (hostname_s, hostname_f, hostname))
+        hostname = self.facts('hostname')['hostname']
+        self.run("sed -i 's,127.0.0.1,127.0.0.1 %s %s %s undercloud.openstacklocal,' /etc/hosts" % (
+            hostname['short'], hostname['file'], hostname['name']))
 
     def openstack_undercloud_install(self):
         """Deploy an undercloud on the host.
         """
-        instack_undercloud_ver, _ = self.run('repoquery --whatprovides /usr/share/instack-undercloud/puppet-stack-config/puppet-stack-config.pp')
-        if instack_undercloud_ver.rstrip('\n') == 'instack-undercloud-0:2.2.0-1.el7ost.noarch':
+        # the versions matter, and the dependencies yum has pulled
+        self.invalidate_facts('packages')
+        packages = self.facts('packages')['packages']
+        if packages.get('instack-undercloud') == '0:2.2.0-1.el7ost.noarch':
             LOG.warn('Workaround for BZ1298189')
             self.run("sed -i \"s/.*Keystone_domain\['heat_domain'\].*/Service\['keystone'\] -> Class\['::keystone::roles::admin'\] -> Class\['::heat::keystone::domain'\]/\" /usr/share/instack-undercloud/puppet-stack-config/puppet-stack-config.pp")
 
-        self.run('OS_PASSWORD=bob openstack undercloud install', user='stack')
+        self.invalidate_facts('packages')
+        self.run('OS_PASSWORD=bob openstack undercloud install', user='stack',
+                 capture=ssh.CapturePolicy())
         # NOTE(Gonéri): we also need this after the overcloud deployment
-        if self.run('rpm -qa openstack-ironic-api')[0].rstrip('\n') == 'openstack-ironic-api-4.2.2-3.el7ost.noarch':
+        packages = self.facts('packages')['packages']
+        if packages.get('openstack-ironic-api') == '0:4.2.2-3.el7ost.noarch':
             LOG.warn('Workaround for BZ1297796')
             self.run('systemctl start openstack-ironic-api.service')
         self.add_environment_file(user='stack', filename='stackrc')
         self.run('heat stack-list', user='stack')
 
     def fetch_overcloud_images(self, files):
+        """Download and extract the overcloud images.
+
+        The images are fetched concurrently. By default, each tarball is
+        extracted while it is downloaded, and is not stored. With
+        keep_tarball, it goes through the image cache first, see
+        Server.fetch_image().
+
+        :param files: a dict of images indexed by name, an image is a dict
+        with the image_path URL and the optional digest and keep_tarball
+        keys. If empty, the images of the rhosp-director-images packages
+        are used.
+        """
         if files:
+            futures = []
             for name in sorted(files):
-                self.fetch_image(
-                    path=files[name]['image_path'],
-                    dest='/home/stack/%s.tar' % name,
-                    user='stack')
-                self.run('tar xf /home/stack/%s.tar' % name,
-                         user='stack')
+                image = files[name]
+                if image.get('keep_tarball'):
+                    dest = '/home/stack/%s.tar' % name
+                    cmd = '%s && tar xf %s' % (image_cache.command(
+                        image['image_path'], dest,
+                        digest=image.get('digest')), dest)
+                else:
+                    cmd = image_cache.extract_command(
+                        image['image_path'], digest=image.get('digest'))
+                futures.append(self.run_async(
+                    cmd, user='stack', retry=3,
+                    custom_log='fetch and extract %s' % image['image_path']))
+            for name, (output, _) in zip(sorted(files), ssh.gather(futures)):
+                if files[name].get('keep_tarball'):
+                    continue
+                digest, size, duration = image_cache.parse_extraction(output)
+                LOG.info('%s extracted: %d MiB in %.1fs, %.1f MiB/s, %s' % (
+                    name, size / 1048576, duration,
+                    size / 1048576.0 / max(duration, 0.001), digest))
         else:
             # OSP specific
             self.yum_install(['rhosp-director-images', 'rhosp-director-images-ipa'])
-            self.run('find /usr/share/rhosp-director-images/ -type f -name "*.tar" -exec tar xf {} \;', user='stack')
+            self.run('find /usr/share/rhosp-director-images/ -type f -name "*.tar" -exec tar xf {} \;', user='stack',
+                     capture=ssh.CapturePolicy())
 
     def overcloud_image_upload(self):
         """Wrapper for: openstack overcloud image upload
@@ -89,7 +126,8 @@ class Undercloud(Server):
         :param files: a list of files to retrieve first.
         """
         self.add_environment_file(user='stack', filename='stackrc')
-        self.run('openstack overcloud image upload', user='stack')
+        self.run('openstack overcloud image upload', user='stack',
+                 capture=ssh.CapturePolicy())
 
     def write_instackenv(self, baremetal_factory):
         self.create_file(
@@ -144,7 +182,8 @@ class Undercloud(Server):
 
     def manage_overcloud_templates(self, templates):
         if templates:
-            self.send_dir(templates, "/home/stack", user='stack')
+            self.send_dir(templates, "/home/stack", user='stack',
+                          compression='gz', delta=True)
         else:
             self.create_file(
                 '/home/stack/network-environment.yaml',
@@ -198,10 +237,10 @@ class Undercloud(Server):
     def list_nodes(self):
         """List the Ironic nodes UUID."""
         self.add_environment_file(user='stack', filename='stackrc')
-        ret, _ = self.run("ironic node-list --fields uuid|awk '/-.*-/ {print $2}'", user='stack')
+        ret, _, _ = self.query("ironic node-list --fields uuid|awk '/-.*-/ {print $2}'", user='stack')
         # NOTE(Gonéri): the good new is, the order of the nodes is preserved and follow the one from
         # the instackenv.json, BUT it may be interesting to add a check.
-        return ret.split()
+        return ret.decode().split()
 
     def set_flavor(self, node, flavor):
         """Set a flavor to a given ironic node.
@@ -226,13 +265,16 @@ class Undercloud(Server):
         self.add_environment_file(user='stack', filename='stackrc')
         if not deploy_command:
             deploy_command = self._prepare_o_o_deploy_command(**kwargs)
-        self.run(deploy_command, user='stack')
+        self.run(deploy_command, user='stack', capture=ssh.CapturePolicy())
         self.run('test -f overcloudrc', user='stack')
 
     def nova_version(self):
         if self._nova_version:
             return self._nova_version
-        nova_version = self.run('nova-manage --version')[0].split(".")[0]
+        stdout, stderr, _ = self.query('nova-manage --version')
+        # NOTE: the argparse of python 2 prints the version on stderr
+        nova_version = (stdout or stderr).decode().strip().split(".")[0]
         # NOTE: before liberty, versions were year-release-version
         # since liberty there is a major 2 digit version for each release
-        return 11 if len(str(nova_version)) == 4 else nova_version
+        self._nova_version = 11 if len(nova_version) == 4 else int(nova_version)
+        return self._nova_version